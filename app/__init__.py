@@ -3,13 +3,17 @@ from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_mail import Mail
-from flask_login import LoginManager
+from flask_login import LoginManager, current_user
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
+from functools import lru_cache
+from babel import Locale
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -37,7 +41,7 @@ moment = Moment(app)
 babel = Babel(app)
 
 #imports various modules from the app package
-from app import routes, models, errors
+from app import routes, models, errors, assets, profiling, availability, api, compress
 
 #set up email notifications for errors
 if not app.debug: #if not in dev mode
@@ -67,14 +71,23 @@ if not app.debug: #if not in dev mode
         app.logger.setLevel(logging.INFO)
         app.logger.info('Coffee shop startup')
 
-#the decorated function is invoked for each request to select a language translation to use for that request
+#the negotiated language depends only on the raw Accept-Language header, so results are memoized in a bounded LRU cache keyed by it.
+#a parsed babel Locale is returned, which flask-babel uses as is instead of parsing the language code again on every request
+def _negotiate_locale(accept_language, languages):
+    #best_match() compares the list of languages requested by the client aginst the languages the application supports and using the client provided weights finds the best language
+    match = parse_accept_header(accept_language, LanguageAccept).best_match(languages)
+    return Locale.parse(match) if match else None
+
+negotiate_locale = lru_cache(maxsize=app.config['LOCALE_CACHE_SIZE'])(_negotiate_locale)
+parse_locale = lru_cache(maxsize=None)(Locale.parse) #only ever called with codes from LANGUAGES
+
+#the decorated function is invoked once per request (flask-babel keeps the result for the rest of the request) to select a language translation to use for that request
 @babel.localeselector
 def get_locale():
-    #uses an attribute of Flask's request object called accept languages.
-    #accept_languages provides a high level interface to work with the accept language header that clients send with a request
-    #best_match() method compares the list of languages requested by the client aginst the languages the application supports and using the client provided weights finds the best language
-    return request.accept_languages.best_match(app.config['LANGUAGES'])
-    # return 'es'
+    #a language saved in the user's profile wins and skips header parsing entirely
+    if current_user.is_authenticated and current_user.locale in app.config['LANGUAGES']:
+        return parse_locale(current_user.locale)
+    return negotiate_locale(request.headers.get('Accept-Language', ''), tuple(app.config['LANGUAGES']))
 
 if __name__ == "__main__":
     app.run(debug=True)
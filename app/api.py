@@ -0,0 +1,74 @@
+from functools import wraps
+from flask import request, g, jsonify, url_for
+from app import app, db, feeds
+from app.models import User, token_denylist
+
+#JSON API authenticated with short lived bearer tokens (User.get_access_token()). a client exchanges a username
+#and password for a token once, then sends 'Authorization: Bearer <token>' with every request. the token's
+#signature and claims are all that is checked, so authenticating an API request costs no query and never
+#goes through the login manager's user loader. tokens are revoked through the denylist (see app/denylist.py)
+
+
+class TokenUser(object):
+    #the authenticated user as described by the token; views that need more than this load the User themselves
+    __slots__ = ('id', 'username', 'jti', 'exp')
+
+    def __init__(self, claims):
+        self.id = int(claims['sub'])
+        self.username = claims['username']
+        self.jti = claims['jti']
+        self.exp = claims['exp']
+
+
+def error_response(status, message):
+    response = jsonify({'error': message})
+    response.status_code = status
+    if status == 401:
+        response.headers['WWW-Authenticate'] = 'Bearer'
+    return response
+
+
+def token_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        claims = User.verify_access_token(token) if scheme.lower() == 'bearer' else None
+        if claims is None:
+            return error_response(401, 'invalid or missing token')
+        g.token_user = TokenUser(claims)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+#exchanges HTTP basic credentials for an access token; the only API request that reads the user table to authenticate
+@app.route('/api/tokens', methods=['POST'])
+def get_token():
+    auth = request.authorization
+    user = User.query.filter_by(username=auth.username).first() if auth else None
+    if user is None or not user.check_password(auth.password or ''):
+        return error_response(401, 'invalid username or password')
+    return jsonify({'token': user.get_access_token(), 'expires_in': app.config['API_TOKEN_EXPIRES']})
+
+
+#revokes the token sent with the request
+@app.route('/api/tokens', methods=['DELETE'])
+@token_required
+def revoke_token():
+    token_denylist.revoke(g.token_user.jti, g.token_user.exp)
+    db.session.commit()
+    return '', 204
+
+
+#the authenticated user's home feed, newest first
+@app.route('/api/feed')
+@token_required
+def api_feed():
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', app.config['POSTS_PER_PAGE'], type=int), 100)
+    posts = feeds.paginate(feeds.followed_feed(g.token_user.id), page, per_page)
+    return jsonify({
+        'items': [{'id': post.id, 'body': post.body, 'timestamp': post.timestamp.isoformat() + 'Z',
+                   'language': post.language, 'author': post.username, 'avatar': post.avatar(70)}
+                  for post in posts.items],
+        'next': url_for('api_feed', page=posts.next_num, per_page=per_page) if posts.has_next else None,
+    })
@@ -0,0 +1,31 @@
+import time
+from datetime import datetime, timedelta
+from app import app, db
+from app.models import Post, PostArchive
+
+#moves posts older than ARCHIVE_HORIZON_DAYS from the post table into post_archive, oldest first, one batch per
+#transaction so locks stay short and the job can be stopped and rerun at any point. archived posts keep their ids,
+#are still shown by the feeds (see feeds.paginate) and stay in the search index (Post.__search_archives__).
+#the post with the highest id is never archived: SQLite hands out max(rowid) + 1 as the next id, so removing it
+#would let a new post reuse the id of an archived one
+
+
+def archive(horizon_days=None, batch_size=None, pause=0):
+    cutoff = datetime.utcnow() - timedelta(days=horizon_days or app.config['ARCHIVE_HORIZON_DAYS'])
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    columns = [column.name for column in PostArchive.__table__.columns]
+    newest = db.session.execute(db.select(db.func.max(Post.id))).scalar()
+    archived = 0
+    while True:
+        ids = db.session.execute(
+            db.select(Post.id).where(Post.timestamp < cutoff, Post.id != newest).order_by(
+                Post.timestamp, Post.id).limit(batch_size)).scalars().all()
+        if not ids:
+            return archived
+        db.session.execute(PostArchive.__table__.insert().from_select(
+            columns, db.select(*[Post.__table__.c[name] for name in columns]).where(Post.id.in_(ids))))
+        db.session.execute(Post.__table__.delete().where(Post.id.in_(ids)))
+        db.session.commit()
+        archived += len(ids)
+        if pause:
+            time.sleep(pause) #gives other writers a turn on busy databases
@@ -0,0 +1,205 @@
+import base64
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import urllib.request
+import flask_bootstrap
+import flask_moment
+from flask import request, send_from_directory, url_for, abort
+from app import app
+
+try:
+    import brotli
+except ImportError: #brotli is optional, without it only gzip variants are generated
+    brotli = None
+
+#static asset pipeline. 'flask assets build' concatenates and minifies the page's CSS and JavaScript into bundles,
+#copies them and the files they reference under content-hashed names into ASSETS_DIST, writes a gzip (and brotli)
+#variant of each, and records the hashed names in manifest.json. the /assets route serves those files with
+#far-future immutable caching and the best precompressed variant the browser accepts; base.html switches to the
+#bundles whenever a manifest is present and falls back to the CDN and unbundled files otherwise
+
+BOOTSTRAP_STATIC = os.path.join(os.path.dirname(flask_bootstrap.__file__), 'static')
+MOMENT_FILE = 'moment-with-locales.min.js'
+MOMENT_URL = 'https://cdnjs.cloudflare.com/ajax/libs/moment.js/{}/{}'.format(
+    flask_moment.default_moment_version, MOMENT_FILE)
+
+#bundle name -> source files, in load order
+BUNDLES = {
+    'app.css': [os.path.join(BOOTSTRAP_STATIC, 'css', 'bootstrap.min.css')],
+    'app.js': [
+        os.path.join(BOOTSTRAP_STATIC, 'jquery.min.js'),
+        os.path.join(BOOTSTRAP_STATIC, 'js', 'bootstrap.min.js'),
+        MOMENT_FILE, #resolved in ASSETS_VENDOR, downloaded on the first build
+        'flask_moment.js', #the supporting code moment.include_moment() would otherwise inline in every page
+        os.path.join(app.static_folder, 'js', 'translate.js'),
+    ],
+}
+#single files that are fingerprinted without bundling
+FILES = {
+    'loading.gif': os.path.join(app.static_folder, 'loading.gif'),
+    'availability.js': os.path.join(app.static_folder, 'js', 'availability.js'), #only used by the registration page
+}
+COMPRESSIBLE = ('.css', '.js', '.svg', '.eot', '.ttf')
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+_css_url_re = re.compile(r'url\(([\'"]?)([^)\'"?#]+)([^)\'"]*)\1\)')
+_css_comment_re = re.compile(r'/\*.*?\*/', re.S)
+_css_space_re = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(css):
+    css = _css_comment_re.sub('', css)
+    css = _css_space_re.sub(r'\1', css)
+    css = re.sub(r':\s+', ':', css) #spaces before ':' are left alone, in a selector they mean a descendant
+    return re.sub(r'\s+', ' ', css).strip()
+
+
+#conservative minifier for our own scripts: drops comment-only lines, indentation and blank lines.
+#third party files are used in their published .min.js form
+def minify_js(js):
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+def _fingerprint(name, data):
+    root, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(root, hashlib.sha256(data).hexdigest()[:12], ext)
+
+
+def _write(dist, name, data, written):
+    with open(os.path.join(dist, name), 'wb') as f:
+        f.write(data)
+    written.add(name)
+    if name.endswith(COMPRESSIBLE):
+        #mtime=0 keeps the .gz output identical between builds of the same content
+        variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(data, quality=11)))
+        for suffix, compressed in variants:
+            with open(os.path.join(dist, name + suffix), 'wb') as f:
+                f.write(compressed)
+            written.add(name + suffix)
+
+
+def _vendor_moment(vendor):
+    path = os.path.join(vendor, MOMENT_FILE)
+    if not os.path.exists(path):
+        data = urllib.request.urlopen(MOMENT_URL).read()
+        #check the download against the subresource integrity hash flask-moment pins for this version
+        algorithm, expected = flask_moment.default_moment_sri.split('-', 1)
+        if base64.b64encode(hashlib.new(algorithm, data).digest()).decode() != expected:
+            raise RuntimeError('integrity check failed for ' + MOMENT_URL)
+        os.makedirs(vendor, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    return path
+
+
+def _read_source(source, vendor):
+    if source == MOMENT_FILE:
+        source = _vendor_moment(vendor)
+    elif source == 'flask_moment.js':
+        return flask_moment.moment.flask_moment_js(), source
+    with open(source, encoding='utf-8') as f:
+        return f.read(), source
+
+
+#copies the files a stylesheet references (fonts, images) under hashed names and points the url()s at them
+def _rewrite_css_urls(css, source, dist, written):
+    def replace(match):
+        quote, path, suffix = match.groups()
+        if path.startswith(('data:', 'http:', 'https:', '/')):
+            return match.group(0)
+        target = os.path.normpath(os.path.join(os.path.dirname(source), path))
+        if not os.path.exists(target):
+            return match.group(0)
+        with open(target, 'rb') as f:
+            data = f.read()
+        name = _fingerprint(os.path.basename(target), data)
+        if name not in written:
+            _write(dist, name, data, written)
+        return 'url({0}{1}{2}{0})'.format(quote, name, suffix)
+    return _css_url_re.sub(replace, css)
+
+
+def build():
+    dist = app.config['ASSETS_DIST']
+    vendor = app.config['ASSETS_VENDOR']
+    os.makedirs(dist, exist_ok=True)
+    manifest = {}
+    written = set()
+    for bundle, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            text, path = _read_source(source, vendor)
+            if bundle.endswith('.css'):
+                parts.append(minify_css(_rewrite_css_urls(text, path, dist, written)))
+            else:
+                parts.append(text if path.endswith('.min.js') else minify_js(text))
+        #a newline plus ';' between scripts keeps one file's last statement from running into the next
+        data = ('\n' if bundle.endswith('.css') else '\n;\n').join(parts).encode('utf-8')
+        manifest[bundle] = _fingerprint(bundle, data)
+        _write(dist, manifest[bundle], data, written)
+    for name, source in FILES.items():
+        with open(source, 'rb') as f:
+            data = f.read()
+        manifest[name] = _fingerprint(name, data)
+        _write(dist, manifest[name], data, written)
+    #files from earlier builds are kept: pages rendered by workers that still hold the old manifest refer to them
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    load_manifest()
+    return manifest
+
+
+_manifest = {}
+
+
+def load_manifest():
+    global _manifest
+    path = os.path.join(app.config['ASSETS_DIST'], 'manifest.json')
+    try:
+        with open(path) as f:
+            _manifest = json.load(f)
+    except (OSError, ValueError):
+        _manifest = {}
+    return _manifest
+
+
+#URL of the built version of an asset, or None when no build is available
+def asset_url(name):
+    if name not in _manifest:
+        return None
+    return url_for('assets', filename=_manifest[name])
+
+
+@app.context_processor
+def inject_assets():
+    return {'asset_url': asset_url, 'assets_built': bool(_manifest)}
+
+
+#serves built assets. names change with their content, so browsers may cache them for a year without revalidating
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    dist = app.config['ASSETS_DIST']
+    if filename.endswith(('.gz', '.br')) or not os.path.isfile(os.path.join(dist, filename)):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    served, encoding = filename, None
+    for candidate, suffix in ENCODINGS:
+        if request.accept_encodings[candidate] and os.path.isfile(os.path.join(dist, filename + suffix)):
+            served, encoding = filename + suffix, candidate
+            break
+    response = send_from_directory(dist, served, mimetype=mimetype, max_age=app.config['ASSETS_MAX_AGE'])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(app.config['ASSETS_MAX_AGE'])
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+load_manifest()
@@ -0,0 +1,129 @@
+import hashlib
+import math
+import threading
+import time
+from flask import request, jsonify, abort
+from app import app, db
+from app.models import User
+
+#live "is this username free?" check for the registration form. taken names are kept in a Bloom filter, a compact
+#bit array that can say "definitely not taken" (answered without a query) or "maybe taken" (confirmed with a query).
+#the filter is built from the user table in a background thread when it is first needed in each process, gets new
+#names as users register or rename, and is rebuilt in the background every AVAILABILITY_REBUILD_INTERVAL seconds,
+#or sooner when it fills up; requests keep using the old filter (or the database, before the first one is ready)
+#meanwhile. other worker processes only see a new name after their next rebuild, so the answer is advisory: the form
+#validators still check the database when the form is submitted. only usernames can be checked, they are public on
+#every profile page anyway; an email check would tell anyone which addresses have an account, which the password
+#reset form is careful not to do
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        #the standard sizing: m bits and k hash functions for n items at false positive rate p
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        #k positions from two 64 bit hashes (Kirsch-Mitzenmacher double hashing)
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + n * second) % self.size for n in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class TakenNames(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.filter = None
+        self.built = 0
+        self.rebuilding = False
+        self.added = [] #names registered while a rebuild is scanning the table
+
+    def rebuild(self):
+        with self.lock:
+            self.added = []
+        names = db.session.query(db.func.count(User.id)).scalar()
+        #room for twice the current names, so the filter stays accurate while new users register
+        bloom = BloomFilter(max(app.config['AVAILABILITY_CAPACITY'], 2 * names), app.config['AVAILABILITY_ERROR_RATE'])
+        for username, in db.session.query(User.username).yield_per(10000):
+            if username is not None:
+                bloom.add(username)
+        with self.lock:
+            for username in self.added:
+                bloom.add(username)
+            self.filter = bloom
+            self.built = time.monotonic()
+
+    def _rebuild_in_background(self):
+        try:
+            with app.app_context():
+                self.rebuild()
+        except Exception:
+            app.logger.exception('Rebuilding the username availability filter failed')
+        finally:
+            with self.lock:
+                self.rebuilding = False
+
+    #starts a rebuild in a background thread unless one is already running
+    def refresh(self):
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def _current(self):
+        bloom = self.filter
+        if bloom is None or bloom.count > bloom.capacity or \
+                time.monotonic() - self.built > app.config['AVAILABILITY_REBUILD_INTERVAL']:
+            self.refresh()
+        return bloom
+
+    def add(self, username):
+        if username is None:
+            return
+        with self.lock:
+            if self.filter is not None:
+                self.filter.add(username)
+            if self.rebuilding:
+                self.added.append(username)
+
+    def is_taken(self, username):
+        bloom = self._current()
+        if bloom is not None and username not in bloom:
+            return False
+        return db.session.query(User.id).filter(User.username == username).first() is not None
+
+
+taken_names = TakenNames()
+
+
+#a name is added as soon as its row is written; if the transaction rolls back it only costs a query later
+@db.event.listens_for(User, 'after_insert')
+def add_new_user(mapper, connection, user):
+    taken_names.add(user.username)
+
+
+#most updates are last_seen, only renames add a name
+@db.event.listens_for(User, 'after_update')
+def add_renamed_user(mapper, connection, user):
+    if db.inspect(user).attrs.username.history.has_changes():
+        taken_names.add(user.username)
+
+
+@app.route('/availability')
+def availability():
+    username = request.args.get('username', '').strip()
+    if not username:
+        abort(400)
+    return jsonify({'field': 'username', 'value': username, 'available': not taken_names.is_taken(username)})
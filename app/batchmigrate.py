@@ -0,0 +1,162 @@
+import logging
+import time
+from datetime import datetime
+import sqlalchemy as sa
+from alembic import op
+from app import app
+
+#helpers for migrations that touch every row of a big table (see migrations/README). instead of one UPDATE or
+#INSERT ... SELECT inside the migration's transaction, rows are processed in key ranges of batch_size rows and
+#every batch is committed on its own (alembic's autocommit_block), so locks are held for one batch at a time.
+#the last finished key is stored in the migration_progress table: when a migration fails or is stopped halfway,
+#running 'flask db upgrade' again runs the whole upgrade() again, so every step has to be safe to repeat. the
+#schema helpers below skip what an earlier run already did, and the row helpers continue after the last committed
+#batch. progress is logged through alembic's logger
+
+logger = logging.getLogger('alembic.batchmigrate')
+
+progress = sa.Table(
+    'migration_progress', sa.MetaData(),
+    sa.Column('name', sa.String(128), primary_key=True),
+    sa.Column('last_key', sa.Integer),
+    sa.Column('rows', sa.Integer, nullable=False, default=0),
+    sa.Column('updated', sa.DateTime),
+)
+
+
+def has_table(name):
+    return sa.inspect(op.get_bind()).has_table(name)
+
+
+def has_column(table, column):
+    return column in [c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)]
+
+
+#the schema steps of a resumable migration: an earlier, interrupted run may already have committed them
+def create_table(name, *columns, **kw):
+    if not has_table(name):
+        op.create_table(name, *columns, **kw)
+
+
+def add_column(table, column):
+    if not has_column(table, column.name):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(column)
+
+
+def _load_progress(connection, name):
+    progress.create(connection, checkfirst=True)
+    row = connection.execute(sa.select(progress.c.last_key, progress.c.rows).where(progress.c.name == name)).first()
+    if row is None:
+        connection.execute(progress.insert().values(name=name, last_key=None, rows=0, updated=datetime.utcnow()))
+        return None, 0
+    if row.last_key is not None:
+        logger.info('%s: resuming after key %s (%d rows done)', name, row.last_key, row.rows)
+    return row.last_key, row.rows
+
+
+def _save_progress(connection, name, last_key, rows):
+    connection.execute(progress.update().where(progress.c.name == name).values(
+        last_key=last_key, rows=rows, updated=datetime.utcnow()))
+
+
+def _in_range(column, low, high):
+    return column <= high if low is None else sa.and_(column > low, column <= high)
+
+
+#yields (low, high] key ranges of at most batch_size rows of `table`, committing the progress after each one.
+#key must be an integer column; it does not have to be unique, a range then simply covers all rows of its last key.
+#rows whose key is NULL are in no range and are left alone
+def batches(name, table, key='id', batch_size=None, rows_per_second=None):
+    batch_size = batch_size or app.config['MIGRATION_BATCH_SIZE']
+    rows_per_second = rows_per_second or app.config['MIGRATION_ROWS_PER_SECOND']
+    column = sa.column(key)
+    source = sa.table(table, column)
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        last, done = _load_progress(connection, name)
+        total, skipped = connection.execute(sa.select(
+            sa.func.count(column), sa.func.count() - sa.func.count(column)).select_from(source)).first()
+        if skipped:
+            logger.warning('%s: %d rows with a NULL %s are skipped', name, skipped, key)
+        while True:
+            started = time.monotonic()
+            window = sa.select(column).where(column.isnot(None)).order_by(column).limit(batch_size)
+            if last is not None:
+                window = window.where(column > last)
+            high = connection.execute(sa.select(sa.func.max(window.subquery().c[key]))).scalar()
+            if high is None:
+                break
+            yield last, high
+            #a range may end in the middle of a run of equal keys, the rows of the last key are still all in it
+            count = connection.execute(sa.select(sa.func.count()).select_from(source).where(
+                _in_range(column, last, high))).scalar()
+            last = high
+            done += count
+            _save_progress(connection, name, last, done)
+            logger.info('%s: %d/%d rows (key %s)', name, done, total, last)
+            if rows_per_second:
+                time.sleep(max(0, float(count) / rows_per_second - (time.monotonic() - started)))
+        connection.execute(progress.delete().where(progress.c.name == name))
+        if connection.execute(sa.select(sa.func.count()).select_from(progress)).scalar() == 0:
+            progress.drop(connection)
+
+
+#sets `values` (column name -> value or SQL expression) on every row of `table`, one key range at a time.
+#`where` narrows the rows that are updated, e.g. sa.text('language IS NULL')
+def backfill(name, table, values, key='id', where=None, batch_size=None, rows_per_second=None):
+    column = sa.column(key)
+    target = sa.table(table, column, *[sa.column(name) for name in values])
+    for low, high in batches(name, table, key, batch_size, rows_per_second):
+        statement = target.update().where(_in_range(column, low, high)).values(values)
+        if where is not None:
+            statement = statement.where(where)
+        op.get_bind().execute(statement)
+
+
+#copies `columns` of every row of `source` into `target`, one key range at a time. used with swap_tables() to
+#rebuild a table into a new definition (new constraints, a different key) while the old one stays readable.
+#each range is first cleared in the target, so a repeated batch does not copy rows twice.
+#with distinct=True duplicate rows are copied once; `where` leaves out the rows it does not match, as does a NULL key.
+#when the copy is done the target must hold as many rows as the source has to copy, otherwise the migration stops
+#here, before swap_tables() could drop the source
+def copy_table(name, source, target, columns, key='id', distinct=False, where=None, batch_size=None,
+               rows_per_second=None):
+    if not has_table(source) or not has_table(target):
+        #an earlier run finished the copy and was stopped in the middle of swap_tables()
+        logger.info('%s: %s or %s is gone, the copy already finished', name, source, target)
+        return
+    source_table = sa.table(source, *[sa.column(column) for column in columns])
+    target_table = sa.table(target, *[sa.column(column) for column in columns])
+
+    def select(rows):
+        rows = rows.where(source_table.c[key].isnot(None))
+        if where is not None:
+            rows = rows.where(where)
+        return rows.distinct() if distinct else rows
+
+    for low, high in batches(name, source, key, batch_size, rows_per_second):
+        connection = op.get_bind()
+        connection.execute(target_table.delete().where(_in_range(target_table.c[key], low, high)))
+        rows = select(sa.select(*source_table.c).where(_in_range(source_table.c[key], low, high)))
+        connection.execute(target_table.insert().from_select(columns, rows))
+    connection = op.get_bind()
+    expected = connection.execute(sa.select(sa.func.count()).select_from(
+        select(sa.select(*source_table.c)).subquery())).scalar()
+    copied = connection.execute(sa.select(sa.func.count()).select_from(target_table)).scalar()
+    if copied != expected:
+        raise RuntimeError('{}: {} has {} rows, {} were expected from {}'.format(
+            name, target, copied, expected, source))
+
+
+#puts `shadow` in place of `table` and drops the old table. runs in the migration's own transaction
+#(indexes keep their names, so create the shadow's indexes under the names the old table used only after the swap).
+#every step checks whether an earlier run already did it
+def swap_tables(table, shadow):
+    old = '_{}_old'.format(table)
+    if has_table(shadow):
+        if has_table(table):
+            op.rename_table(table, old)
+        op.rename_table(shadow, table)
+    if has_table(old):
+        op.drop_table(old)
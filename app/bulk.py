@@ -0,0 +1,118 @@
+import csv
+import json
+import os
+from datetime import datetime
+from app import db
+from app.models import User, Post, PostArchive, followers
+
+#streaming bulk export/import of users, posts (live and archived) and the followers graph, used by the 'flask data' commands.
+#rows are read with keyset pagination and written line by line, and imported in fixed size batches with
+#Core bulk inserts, so memory use depends on the chunk size and not on the size of the data
+
+#tables in dependency order (users before the rows that reference them) with the columns that give a stable, unique sort order
+TABLES = [
+    ('users', User.__table__, ['id']),
+    ('posts', Post.__table__, ['id']),
+    ('posts_archive', PostArchive.__table__, ['id']),
+    ('followers', followers, ['follower_id', 'followed_id']),
+]
+FORMATS = ['ndjson', 'csv']
+#CSV has no way to tell NULL from an empty string, so NULL is written with the same marker PostgreSQL COPY uses
+CSV_NULL = '\\N'
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _decoders(table):
+    #datetime columns come back as ISO 8601 strings and CSV gives every value as a string, so both are converted back
+    decoders = {}
+    for column in table.columns:
+        if isinstance(column.type, db.DateTime):
+            decoders[column.name] = datetime.fromisoformat
+        elif isinstance(column.type, db.Integer):
+            decoders[column.name] = int
+    return decoders
+
+
+def iter_rows(table, keys, chunk_size):
+    key_columns = [table.c[key] for key in keys]
+    last = None
+    while True:
+        query = db.select(table).order_by(*key_columns).limit(chunk_size)
+        if last is not None:
+            query = query.where(db.tuple_(*key_columns) > db.tuple_(*last))
+        rows = db.session.execute(query).mappings().all()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = [rows[-1][key] for key in keys]
+
+
+def export_table(table, keys, path, fmt, chunk_size):
+    count = 0
+    columns = [column.name for column in table.columns]
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
+        for row in iter_rows(table, keys, chunk_size):
+            if fmt == 'csv':
+                writer.writerow([CSV_NULL if row[name] is None else _encode(row[name]) for name in columns])
+            else:
+                f.write(json.dumps({name: _encode(row[name]) for name in columns}) + '\n')
+            count += 1
+    return count
+
+
+def read_rows(table, path, fmt):
+    decoders = _decoders(table)
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            reader = csv.reader(f)
+            header = next(reader)
+            records = (dict(zip(header, (None if value == CSV_NULL else value for value in values)))
+                       for values in reader)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for record in records:
+            for name, decode in decoders.items():
+                if record.get(name) is not None:
+                    record[name] = decode(record[name])
+            yield record
+
+
+def import_table(table, path, fmt, batch_size):
+    count = 0
+    batch = []
+    for record in read_rows(table, path, fmt):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            count += _insert_batch(table, batch)
+            batch = []
+    if batch:
+        count += _insert_batch(table, batch)
+    _reset_sequence(table)
+    return count
+
+
+#one transaction per batch keeps locks short; a failed import keeps every batch committed before the error
+def _insert_batch(table, batch):
+    db.session.execute(table.insert(), batch)
+    db.session.commit()
+    return len(batch)
+
+
+#rows are imported with their original ids, so on PostgreSQL the id sequence has to be moved past them
+def _reset_sequence(table):
+    if db.engine.dialect.name == 'postgresql' and 'id' in table.c:
+        db.session.execute(db.text(
+            "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), COALESCE(MAX(id), 1)) FROM \"{0}\"".format(
+                table.name)))
+        db.session.commit()
+
+
+def table_path(directory, name, fmt):
+    return os.path.join(directory, '{}.{}'.format(name, fmt))
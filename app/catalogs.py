@@ -0,0 +1,183 @@
+import hashlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from babel.messages.catalog import Catalog
+from babel.messages.extract import DEFAULT_KEYWORDS, extract_from_file
+from babel.messages.frontend import parse_mapping_cfg
+from babel.messages.mofile import write_mo
+from babel.messages.pofile import read_po, write_po
+from babel.util import LOCALTZ, pathmatch
+from app import app
+
+#in-process replacement for the pybabel extract/init/update/compile commands behind 'flask translate'.
+#extraction is incremental: the messages found in every source file are kept in CACHE_FILE together with the
+#file's mtime, size and hash, and a file is only parsed again when its content changed. the message template is
+#kept in memory, .po files are only rewritten when their messages change, and only languages whose .po is newer
+#than their .mo are compiled, in parallel worker processes
+
+BASEDIR = os.path.dirname(app.root_path)
+MAPPING_FILE = os.path.join(BASEDIR, 'babel.cfg')
+TRANSLATIONS = os.path.join(app.root_path, 'translations')
+CACHE_FILE = os.path.join(BASEDIR, '.babel-cache.json')
+KEYWORDS = dict(DEFAULT_KEYWORDS, _l=None) #_l() is flask_babel's lazy_gettext
+WIDTH = 76 #pybabel's default line width, so files written here diff cleanly against ones written by pybabel
+
+
+def _sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _mapping():
+    with open(MAPPING_FILE) as f:
+        return parse_mapping_cfg(f, MAPPING_FILE)
+
+
+#source files matched by babel.cfg, as (path relative to BASEDIR with '/' separators, method, options)
+def source_files():
+    method_map, options_map = _mapping()
+    for root, dirnames, filenames in os.walk(BASEDIR):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith(('.', '_')))
+        for filename in sorted(filenames):
+            path = os.path.relpath(os.path.join(root, filename), BASEDIR).replace(os.sep, '/')
+            for pattern, method in method_map:
+                if pathmatch(pattern, path):
+                    if method != 'ignore':
+                        yield path, method, options_map.get(pattern, {})
+                    break
+
+
+def _load_cache(key):
+    try:
+        with open(CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    #a changed babel.cfg or keyword list can change what is found in any file
+    return cache['files'] if cache.get('key') == key else {}
+
+
+#returns the message template and (files, files parsed again) counts
+def extract():
+    with open(MAPPING_FILE, 'rb') as f:
+        key = hashlib.sha1(f.read() + repr(sorted(KEYWORDS.items())).encode()).hexdigest()
+    cached = _load_cache(key)
+    files = {}
+    parsed = 0
+    catalog = Catalog(charset='utf-8')
+    for path, method, options in source_files():
+        full_path = os.path.join(BASEDIR, path)
+        stat = os.stat(full_path)
+        entry = cached.get(path)
+        if entry is None or entry['method'] != method or \
+                (entry['mtime'], entry['size']) != (stat.st_mtime, stat.st_size):
+            sha1 = _sha1(full_path)
+            if entry is None or entry['method'] != method or entry['sha1'] != sha1:
+                #plural messages are tuples, which JSON stores as lists
+                entry = {'method': method, 'sha1': sha1, 'messages': [
+                    [lineno, message, comments, context] for lineno, message, comments, context in
+                    extract_from_file(method, full_path, KEYWORDS, options=options)]}
+                parsed += 1
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+        files[path] = entry
+        for lineno, message, comments, context in entry['messages']:
+            if isinstance(message, list):
+                message = tuple(message)
+            catalog.add(message, None, [(path, lineno)], auto_comments=comments, context=context)
+    with open(CACHE_FILE, 'w') as f:
+        json.dump({'key': key, 'files': files}, f)
+    return catalog, len(files), parsed
+
+
+def _po_path(lang):
+    return os.path.join(TRANSLATIONS, lang, 'LC_MESSAGES', 'messages.po')
+
+
+def languages():
+    if not os.path.isdir(TRANSLATIONS):
+        return []
+    return sorted(lang for lang in os.listdir(TRANSLATIONS) if os.path.exists(_po_path(lang)))
+
+
+def _template_bytes(template):
+    buffer = io.BytesIO()
+    write_po(buffer, template, width=WIDTH)
+    return buffer.getvalue()
+
+
+def init(template, lang):
+    catalog = read_po(io.BytesIO(_template_bytes(template)), locale=lang)
+    catalog.revision_date = datetime.now(LOCALTZ)
+    catalog.fuzzy = False
+    os.makedirs(os.path.dirname(_po_path(lang)), exist_ok=True)
+    with open(_po_path(lang), 'wb') as f:
+        write_po(f, catalog, width=WIDTH)
+
+
+#merges the template into every language and returns the languages whose .po file changed.
+#the creation date is not copied from the template, otherwise every run would rewrite every file
+def update(template):
+    changed = []
+    for lang in languages():
+        path = _po_path(lang)
+        with open(path, 'rb') as f:
+            old = f.read()
+        catalog = read_po(io.BytesIO(old), locale=lang)
+        catalog.update(template, update_header_comment=False, keep_user_comments=True, update_creation_date=False)
+        buffer = io.BytesIO()
+        write_po(buffer, catalog, width=WIDTH)
+        if buffer.getvalue() != old:
+            with open(path, 'wb') as f:
+                f.write(buffer.getvalue())
+            changed.append(lang)
+    return changed
+
+
+def _mo_path(lang):
+    return os.path.join(TRANSLATIONS, lang, 'LC_MESSAGES', 'messages.mo')
+
+
+def stale_languages():
+    return [lang for lang in languages()
+            if not os.path.exists(_mo_path(lang)) or os.path.getmtime(_mo_path(lang)) < os.path.getmtime(_po_path(lang))]
+
+
+#runs in a worker process; returns (lang, translated messages, seconds, problems) like pybabel compile reports them.
+#fuzzy catalogs are skipped and fuzzy translations left out, also like pybabel compile
+def compile_language(lang):
+    start = time.perf_counter()
+    with open(_po_path(lang), 'rb') as f:
+        catalog = read_po(f, locale=lang)
+    if catalog.fuzzy:
+        return lang, 0, time.perf_counter() - start, ['catalog is marked as fuzzy, skipping']
+    problems = ['{}: {}'.format(message.id, error) for message, errors in catalog.check() for error in errors]
+    with open(_mo_path(lang), 'wb') as f:
+        write_mo(f, catalog)
+    translated = sum(1 for message in list(catalog)[1:] if message.string and not message.fuzzy)
+    return lang, translated, time.perf_counter() - start, problems
+
+
+def compile(langs):
+    if len(langs) < 2:
+        return [compile_language(lang) for lang in langs]
+    with ProcessPoolExecutor(max_workers=min(len(langs), os.cpu_count() or 1)) as pool:
+        return list(pool.map(compile_language, langs))
+
+
+#calls on_change whenever a source file or a .po file is added, removed or saved, until interrupted
+def watch(on_change, interval=1.0):
+    snapshot = None
+    while True:
+        paths = [os.path.join(BASEDIR, path) for path, method, options in source_files()] + \
+            [_po_path(lang) for lang in languages()]
+        current = {path: os.path.getmtime(path) for path in paths if os.path.exists(path)}
+        if current != snapshot:
+            if snapshot is not None:
+                on_change()
+            #on_change may rewrite .po files, take the snapshot after it so that does not count as a change
+            snapshot = {path: os.path.getmtime(path) for path in current if os.path.exists(path)}
+        time.sleep(interval)
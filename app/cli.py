@@ -1,5 +1,8 @@
 from app import app
+from app.models import Post
+from app import bulk, rollups as rollups_job, suggestions as suggestions_job, assets as assets_pipeline, archive as archive_job, profiling, catalogs
 import os
+import time
 import click
 
 #decorator (@app.cli.group()) transforms translate() function into a command group within Flask's CLI
@@ -12,27 +15,187 @@ def translate():        #translate does not have any code in it because it is us
 @click.argument('lang') #uses the @click.argument decorator to define the language code
 def init(lang): #click then passes the value provided in the command to the handler function as an argument
     """Initialize a new language"""
-    if os.system('pybabel extract -F babel.cfg -k _l -o messages.pot .'):
-        raise RuntimeError('extract command failed')
-    if os.system('pybabel init -i messages.pot -d app/translations -l ' + lang):
-        raise RuntimeError('init command failed')
-    os.remove('messages.pot')
-        
+    template = extract_messages()
+    catalogs.init(template, lang)
+    click.echo('created {}'.format(lang))
+
 
 #updates the translation files based on the source code of application
 @translate.command()
-def update():
+@click.option('--watch', is_flag=True, help='Keep running, updating and compiling whenever a source or .po file changes.')
+def update(watch):
     """Update all languages"""
-    if os.system('pybabel extract -F babel.cfg -k _l -o messages.pot .'): #exctracts translatable messages from the application source code andd stores them in a .pot file named messages.pot
-        raise RuntimeError('extract command failed')
-    if os.system('pybabel update -i messages.pot -d app/translations'): #updates the translation files in app/translations directory based on the messages extracted in the previous step
-        raise RuntimeError('update command failed')
-    os.remove('messages.pot') #removes the temporary .pot file that was generated after updating the translations
+    def run():
+        start = time.perf_counter()
+        changed = catalogs.update(extract_messages())
+        click.echo('updated {} in {:.2f}s'.format(', '.join(changed) or 'no languages', time.perf_counter() - start))
+        if watch:
+            compile_languages(catalogs.stale_languages())
+    run()
+    if watch:
+        click.echo('watching for changes, press Ctrl+C to stop')
+        try:
+            catalogs.watch(run)
+        except KeyboardInterrupt:
+            pass
+
 
 #complies the translation files into a binary format that can be efficiently used by the application to display translated content.
+#only languages whose .po file changed since they were last compiled are compiled, unless --all is given
 @translate.command()
-def compile():
+@click.option('--all', 'all_languages', is_flag=True, help='Compile every language, changed or not.')
+def compile(all_languages):
     """Compile all languages"""
-    if os.system('pybabel compile -d app/translations'): #compiles the translation files located in the app/translations directory into binary .mo files that the application can use to display translated content
-        raise RuntimeError('compile command failed')
+    compile_languages(catalogs.languages() if all_languages else catalogs.stale_languages())
+
+
+#the message template is kept in memory, no messages.pot file is written
+def extract_messages():
+    start = time.perf_counter()
+    template, files, parsed = catalogs.extract()
+    click.echo('extracted {} messages from {} files ({} parsed, {} cached) in {:.2f}s'.format(
+        len(template), files, parsed, files - parsed, time.perf_counter() - start))
+    return template
+
+
+def compile_languages(langs):
+    start = time.perf_counter()
+    for lang, translated, elapsed, problems in catalogs.compile(langs):
+        for problem in problems:
+            click.echo('{}: {}'.format(lang, problem))
+        click.echo('compiled {} ({} messages) in {:.2f}s'.format(lang, translated, elapsed))
+    click.echo('compiled {} languages in {:.2f}s'.format(len(langs), time.perf_counter() - start))
+
+
+#command group for maintaining the full text search index of posts
+@app.cli.group()
+def search():
+    """Full text search commands."""
+    pass
+
+#rebuilds the index from scratch, needed after bulk loads or when switching SEARCH_BACKEND
+@search.command()
+def reindex():
+    """Rebuild the post search index"""
+    Post.reindex()
+
+#command group for moving users, posts and followers in and out of the database in bulk
+@app.cli.group()
+def data():
+    """Bulk data import and export commands."""
+    pass
+
+#writes one file per table (users, posts, followers) into DIRECTORY, reading the tables in chunks
+@data.command('export')
+@click.argument('directory')
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), default='ndjson', help='Output file format.')
+@click.option('--chunk-size', default=5000, help='Rows read from the database per query.')
+def export_data(directory, fmt, chunk_size):
+    """Export users, posts and followers"""
+    os.makedirs(directory, exist_ok=True)
+    for name, table, keys in bulk.TABLES:
+        start = time.perf_counter()
+        count = bulk.export_table(table, keys, bulk.table_path(directory, name, fmt), fmt, chunk_size)
+        report_throughput('exported', name, count, time.perf_counter() - start)
+
+#loads the files written by 'flask data export' with bulk inserts, committing every batch. password hashes are copied as they are
+@data.command('import')
+@click.argument('directory')
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), default='ndjson', help='Input file format.')
+@click.option('--batch-size', default=5000, help='Rows inserted per transaction.')
+@click.option('--reindex/--no-reindex', default=True, help='Rebuild the search index after importing posts.')
+def import_data(directory, fmt, batch_size, reindex):
+    """Import users, posts and followers"""
+    for name, table, keys in bulk.TABLES:
+        path = bulk.table_path(directory, name, fmt)
+        if not os.path.exists(path):
+            click.echo('skipping {}: {} not found'.format(name, path))
+            continue
+        start = time.perf_counter()
+        count = bulk.import_table(table, path, fmt, batch_size)
+        report_throughput('imported', name, count, time.perf_counter() - start)
+    #bulk inserts bypass the ORM events that keep the search index and the activity rollups up to date
+    if reindex:
+        Post.reindex()
+    rollups_job.rebuild()
+
+def report_throughput(action, name, count, elapsed):
+    click.echo('{} {} {} in {:.2f}s ({:.0f} rows/s)'.format(action, count, name, elapsed, count / elapsed if elapsed else 0))
+
+#command group for the offline who-to-follow job
+@app.cli.group()
+def suggestions():
+    """Who-to-follow suggestion commands."""
+    pass
+
+#meant to run periodically (e.g. from cron); pages only read the stored results
+@suggestions.command()
+@click.option('--batch-size', default=1000, help='Users whose suggestions are replaced per transaction.')
+def build(batch_size):
+    """Recompute who-to-follow suggestions for every user"""
+    start = time.perf_counter()
+    count = suggestions_job.build(batch_size)
+    click.echo('stored {} suggestions in {:.2f}s'.format(count, time.perf_counter() - start))
+
+#command group for the activity rollup tables behind the trending page and profile stats
+@app.cli.group()
+def rollups():
+    """Activity rollup commands."""
+    pass
+
+#meant to run periodically (e.g. hourly from cron)
+@rollups.command()
+@click.option('--batch-size', default=1000, help='Hourly rows folded per transaction.')
+def compact(batch_size):
+    """Fold old hourly activity into daily rows"""
+    click.echo('compacted {} hourly rows'.format(rollups_job.compact(batch_size)))
+
+@rollups.command()
+def rebuild():
+    """Recount post activity from the post and archive tables"""
+    rollups_job.rebuild()
+
+#command group for the static asset pipeline
+@app.cli.group()
+def assets():
+    """Static asset commands."""
+    pass
+
+#run as part of every deploy; pages use the bundles as soon as the manifest exists
+@assets.command('build')
+def build_assets():
+    """Bundle, fingerprint and precompress static assets"""
+    start = time.perf_counter()
+    for name, built in sorted(assets_pipeline.build().items()):
+        click.echo('{} -> {}'.format(name, built))
+    click.echo('built assets in {:.2f}s'.format(time.perf_counter() - start))
+
+#command group for post table maintenance
+@app.cli.group()
+def posts():
+    """Post maintenance commands."""
+    pass
+
+#meant to run periodically (e.g. nightly from cron); safe to interrupt and rerun
+@posts.command('archive')
+@click.option('--horizon-days', type=int, help='Archive posts older than this many days (default ARCHIVE_HORIZON_DAYS).')
+@click.option('--batch-size', type=int, help='Posts moved per transaction (default ARCHIVE_BATCH_SIZE).')
+@click.option('--pause', default=0.0, help='Seconds to sleep between batches.')
+def archive_posts(horizon_days, batch_size, pause):
+    """Move old posts to the archive table"""
+    start = time.perf_counter()
+    count = archive_job.archive(horizon_days, batch_size, pause)
+    report_throughput('archived', 'posts', count, time.perf_counter() - start)
+
+#command group for on-demand request profiling
+@app.cli.group()
+def profile():
+    """Request profiling commands."""
+    pass
 
+#send the token in the X-Profile-Token header (or as ?profile=<token>) to profile a request
+@profile.command()
+@click.option('--expires-in', default=3600, help='Seconds the token stays valid.')
+def token(expires_in):
+    """Print a token that turns on profiling for a request"""
+    click.echo(profiling.get_profile_token(expires_in))
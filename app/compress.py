@@ -0,0 +1,239 @@
+import re
+import zlib
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+from app import app
+
+try:
+    import brotli
+except ImportError: #brotli and zstandard are optional, gzip is always available
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#WSGI middleware that compresses dynamic responses and minifies HTML on the way out. the encoding is the first of
+#COMPRESS_ENCODINGS the client accepts (and that is installed); responses are compressed as the application yields
+#them, each chunk flushed straight to the client, so long pages are never held back in full. bodies smaller than
+#COMPRESS_MIN_SIZE are sent as they are, compression would cost more than it saves. event streams, responses that
+#are already encoded (the precompressed /assets files) and types not listed in COMPRESS_MIMETYPES pass through.
+#HTML minification only collapses runs of whitespace (a run with a newline becomes one newline) in the text between
+#tags, which browsers render the same way; tags and their attribute values, comments and the contents of <pre>,
+#<textarea>, <script> and <style> are left untouched. a transformed body no longer matches byte ranges of the
+#original, so Accept-Ranges is dropped from it
+
+
+class GzipStream(object):
+    def __init__(self, level):
+        #wbits 16 + MAX_WBITS writes the gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliStream(object):
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdStream(object):
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+STREAMS = {'gzip': GzipStream}
+if brotli is not None:
+    STREAMS['br'] = BrotliStream
+if zstandard is not None:
+    STREAMS['zstd'] = ZstdStream
+
+_protected_re = re.compile(r'<(pre|textarea|script|style)\b.*?</\1\s*>', re.S | re.I)
+_protected_open_re = re.compile(r'<(?:pre|textarea|script|style)\b', re.I)
+#a tag (quoted attribute values may contain '>') or a comment
+_tag_re = re.compile(r'<!--.*?-->|<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.S)
+_newline_space_re = re.compile(r'\s*\n\s*')
+_space_re = re.compile(r'[ \t\r\f\v]{2,}')
+
+
+def minify_html(html):
+    parts = []
+    position = 0
+    for match in _protected_re.finditer(html):
+        parts.append(_collapse(html[position:match.start()]))
+        parts.append(match.group(0))
+        position = match.end()
+    parts.append(_collapse(html[position:]))
+    return ''.join(parts)
+
+
+#collapses whitespace in the text between the tags of `html`, which holds no protected element
+def _collapse(html):
+    parts = []
+    position = 0
+    for match in _tag_re.finditer(html):
+        parts.append(_collapse_text(html[position:match.start()]))
+        parts.append(match.group(0))
+        position = match.end()
+    parts.append(_collapse_text(html[position:]))
+    return ''.join(parts)
+
+
+def _collapse_text(text):
+    return _space_re.sub(' ', _newline_space_re.sub('\n', text))
+
+
+class HTMLMinifier(object):
+    #minifies a document that arrives in chunks: text is only minified up to a point where no tag or protected
+    #element is cut in half, the rest waits for the next chunk
+
+    def __init__(self, charset):
+        self.charset = charset
+        self.pending = ''
+
+    def feed(self, data):
+        text = self.pending + data.decode(self.charset, 'surrogateescape')
+        cut = 0
+        for match in _tag_re.finditer(text):
+            cut = match.end()
+        #a protected element that is still open must not be split either
+        last_complete = 0
+        for match in _protected_re.finditer(text):
+            last_complete = match.end()
+        opening = _protected_open_re.search(text, last_complete)
+        if opening is not None:
+            cut = min(cut, opening.start())
+        self.pending = text[cut:]
+        return minify_html(text[:cut]).encode(self.charset, 'surrogateescape')
+
+    def finish(self):
+        text, self.pending = self.pending, ''
+        return minify_html(text).encode(self.charset, 'surrogateescape')
+
+
+def choose_encoding(accept_encoding, encodings):
+    accepted = parse_accept_header(accept_encoding)
+    for encoding in encodings:
+        if encoding in STREAMS and accepted[encoding]:
+            return encoding
+    return None
+
+
+class Compressor(object):
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            #nothing has been sent yet, so an error page may still replace the headers
+            captured[:] = [status, headers]
+            return pending.append #the legacy write() callable, its data is sent before the iterable's
+
+        pending = []
+        body = self.wsgi_app(environ, capture)
+        try:
+            iterator = iter(body)
+            #the application calls start_response no later than when it yields its first chunk
+            first = next(iterator, None)
+            if first is not None:
+                pending.append(first)
+            status, headers = captured
+            headers = Headers(headers)
+            plan = self.plan(environ, status, headers)
+            if plan is None:
+                start_response(status, headers.to_wsgi_list())
+                for chunk in pending:
+                    yield chunk
+                for chunk in iterator:
+                    yield chunk
+                return
+            for chunk in self.transform(plan, status, headers, pending, iterator, start_response):
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    #what to do with the response: (encoding or None, minify); None to pass it through untouched
+    def plan(self, environ, status, headers):
+        config = self.config
+        mimetype, _, params = headers.get('Content-Type', '').partition(';')
+        mimetype = mimetype.strip().lower()
+        if mimetype not in config['COMPRESS_MIMETYPES'] or 'Content-Encoding' in headers or \
+                environ.get('REQUEST_METHOD') == 'HEAD' or status[:3] in ('204', '206', '304') or \
+                'no-transform' in headers.get('Cache-Control', ''):
+            return None
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''), config['COMPRESS_ENCODINGS'])
+        minify = config['COMPRESS_MINIFY_HTML'] and mimetype == 'text/html'
+        length = headers.get('Content-Length', type=int)
+        if length is not None and length < config['COMPRESS_MIN_SIZE']:
+            encoding = None
+        if encoding is None and not minify:
+            return None
+        headers.pop('Accept-Ranges', None)
+        charset = re.search(r'charset=([\w-]+)', params)
+        return encoding, minify, charset.group(1) if charset else 'utf-8'
+
+    def transform(self, plan, status, headers, pending, iterator, start_response):
+        encoding, minify, charset = plan
+        minifier = HTMLMinifier(charset) if minify else None
+        #the start of the body is collected first: a body that ends below the size threshold is sent uncompressed
+        size = sum(len(chunk) for chunk in pending)
+        complete = False
+        while size < self.config['COMPRESS_MIN_SIZE']:
+            chunk = next(iterator, None)
+            if chunk is None:
+                complete = True
+                break
+            pending.append(chunk)
+            size += len(chunk)
+        headers.pop('Content-Length', None)
+        if complete:
+            data = b''.join(pending)
+            if minifier is not None:
+                data = minifier.feed(data) + minifier.finish()
+            headers['Content-Length'] = str(len(data))
+            start_response(status, headers.to_wsgi_list())
+            yield data
+            return
+        stream = None
+        if encoding is not None:
+            stream = STREAMS[encoding](self.config['COMPRESS_LEVELS'][encoding])
+            headers['Content-Encoding'] = encoding
+            etag = headers.get('ETag')
+            if etag and not etag.startswith('W/'):
+                headers['ETag'] = 'W/' + etag #the compressed bytes differ from the ones the strong tag names
+        start_response(status, headers.to_wsgi_list())
+        for chunks in (pending, iterator):
+            for chunk in chunks:
+                if minifier is not None:
+                    chunk = minifier.feed(chunk)
+                if chunk:
+                    yield stream.compress(chunk) if stream is not None else chunk
+        tail = minifier.finish() if minifier is not None else b''
+        yield stream.compress(tail) + stream.finish() if stream is not None else tail
+
+
+app.wsgi_app = Compressor(app.wsgi_app, app.config)
@@ -0,0 +1,73 @@
+import threading
+import time
+from app import db
+
+#revoked API access tokens (see User.get_access_token()). revocations are rows of the revoked_token table, so every
+#worker process sees them: a token id with the token's exp, or a cutoff time that revokes every token a user was
+#issued up to then. tokens are short lived, so a revocation only has to be kept until the tokens it covers would
+#have expired anyway; rows past that are deleted as new ones are written, which keeps the table to the revocations
+#of one token lifetime. each process keeps a copy of the table that it reloads at most every `refresh` seconds,
+#so checking a token usually runs no query. a token revoked in another process keeps working here until the next
+#reload; revocations made in this process apply at once
+
+
+class TokenDenylist(object):
+    def __init__(self, model, lifetime, refresh):
+        self.model = model
+        self.lifetime = lifetime #seconds a token is valid, how long a user cutoff has to be kept
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.users = {}
+        self.loaded = None
+
+    #replaces the copy with the unexpired rows; a thread that finds another one reloading keeps using the old copy
+    def _load(self, now):
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            tokens = {}
+            users = {}
+            model = self.model
+            for jti, user_id, revoked_at, expires in db.session.execute(db.select(
+                    model.jti, model.user_id, model.revoked_at, model.expires).where(model.expires > now)):
+                if jti is not None:
+                    tokens[jti] = expires
+                else:
+                    users[user_id] = max(revoked_at, users.get(user_id, revoked_at))
+            self.tokens = tokens
+            self.users = users
+            self.loaded = now
+        finally:
+            self.lock.release()
+
+    #the revocation is written as part of the caller's transaction and applies in this process straight away
+    def _add(self, now, jti=None, user_id=None, expires=None):
+        model = self.model
+        db.session.execute(db.delete(model).where(model.expires <= now))
+        db.session.add(model(jti=jti, user_id=user_id, revoked_at=now, expires=expires))
+
+    def revoke(self, jti, exp):
+        now = time.time()
+        self._add(now, jti=jti, expires=exp)
+        self.tokens[jti] = exp
+
+    #revokes every token of the user issued up to now, e.g. after a password change
+    def revoke_user(self, user_id):
+        now = time.time()
+        self._add(now, user_id=user_id, expires=now + self.lifetime)
+        self.users[user_id] = now
+
+    def is_revoked(self, jti, user_id, issued_at):
+        now = time.time()
+        if self.loaded is None or now - self.loaded >= self.refresh:
+            self._load(now)
+        cutoff = self.users.get(user_id)
+        return jti in self.tokens or (cutoff is not None and issued_at <= cutoff)
+
+    #forgets the copy, the next check reloads it from the table
+    def clear(self):
+        with self.lock:
+            self.tokens = {}
+            self.users = {}
+            self.loaded = None
@@ -0,0 +1,115 @@
+from app import db
+from app.models import User, Post, PostArchive, followers, avatar_digest, avatar_url
+from app.search import query_index
+
+#read-only query layer for the post feeds. only the columns _post.html needs are selected and each row becomes
+#a small PostRow, so rendering a page skips building Post/User objects, the identity map and change tracking.
+#the write paths (creating posts, editing profiles) keep using the models
+
+
+class PostRow(object):
+    __slots__ = ('id', 'body', 'timestamp', 'language', 'user_id', 'username', 'avatar_digest')
+
+    def __init__(self, id, body, timestamp, language, user_id, username, avatar_digest):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.language = language
+        self.user_id = user_id
+        self.username = username
+        self.avatar_digest = avatar_digest
+
+    def avatar(self, size):
+        return avatar_url(self.avatar_digest, size)
+
+    def __repr__(self):
+        return '<PostRow {}>'.format(self.body)
+
+
+#page of rows with the same attributes as Flask-SQLAlchemy's Pagination that the views use.
+#one extra row is fetched to know if there is a next page, so no COUNT query is needed
+class FeedPage(object):
+    __slots__ = ('items', 'page', 'has_next')
+
+    def __init__(self, items, page, has_next):
+        self.items = items
+        self.page = page
+        self.has_next = has_next
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+
+def _select(model=Post):
+    return db.select(model.id, model.body, model.timestamp, model.language, model.user_id, User.username,
+                     User.email).join(User, User.id == model.user_id)
+
+
+def _rows(query):
+    return [PostRow(id, body, timestamp, language, user_id, username, avatar_digest(email or ''))
+            for id, body, timestamp, language, user_id, username, email in db.session.execute(query)]
+
+
+#a feed is a function that builds its query for a given post table (Post or PostArchive).
+#with the archive the page is cut from both tables merged on (timestamp, id), the same order as each table's own
+#pages, so the posts the archive job keeps back (see app/archive.py) sort in among the archived ones. each table
+#contributes at most the rows that can reach the page, read from its timestamp index
+def paginate(feed, page, per_page, archive=True):
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    limit = offset + per_page + 1
+    if archive:
+        parts = [feed(model).order_by(model.timestamp.desc(), model.id.desc()).limit(limit).subquery()
+                 for model in (Post, PostArchive)]
+        merged = db.union_all(*[db.select(part) for part in parts]).subquery()
+        query = db.select(merged).order_by(merged.c.timestamp.desc(), merged.c.id.desc())
+    else:
+        query = feed(Post).order_by(Post.timestamp.desc(), Post.id.desc())
+    rows = _rows(query.limit(per_page + 1).offset(offset))
+    return FeedPage(rows[:per_page], page, len(rows) > per_page)
+
+
+#posts by the users user_id follows plus their own, same rows as User.followed_posts()
+def followed_feed(user_id):
+    followed = db.select(followers.c.followed_id).where(followers.c.follower_id == user_id)
+    return lambda model: _select(model).where(db.or_(model.user_id.in_(followed), model.user_id == user_id))
+
+
+def user_feed(user_id):
+    return lambda model: _select(model).where(model.user_id == user_id)
+
+
+def explore_feed():
+    return _select
+
+
+#recent posts by the given authors; the timestamp filter keeps the query on the timestamp index
+def trending_feed(author_ids, since):
+    return lambda model: _select(model).where(model.user_id.in_(author_ids), model.timestamp >= since)
+
+
+#rows for the given post ids, in the order of the ids
+def rows_for_ids(ids):
+    if not ids:
+        return []
+    found = {row.id: row for row in _rows(_select().where(Post.id.in_(ids)))}
+    missing = [id for id in ids if id not in found]
+    if missing:
+        #archived posts are still in the search index
+        found.update((row.id, row) for row in _rows(_select(PostArchive).where(PostArchive.id.in_(missing))))
+    return [found[id] for id in ids if id in found]
+
+
+#one page of search results as rows, plus the cursor of the next page
+def search_feed(expression, cursor, per_page):
+    ids, next_cursor = query_index(Post.__tablename__, Post, expression, cursor, per_page)
+    return rows_for_ids(ids), next_cursor
@@ -0,0 +1,72 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+#in-process cache of "who does this user follow", used by User.is_following() so that follow buttons and
+#"follows you" badges across a page cost no queries. each user's followed ids are kept as one sorted array
+#of 8 byte integers (membership is a binary search); users following more than max_ids people are not
+#cached, only remembered as too big for the ttl so their ids are not loaded again on every check, and at most
+#`size` users are kept, least recently used first out, so memory stays bounded.
+#entries expire after `ttl` seconds because follows made through another worker process are not seen here.
+#changes are invalidated once they are committed (see app/models.py); a load that was running while an entry was
+#invalidated is returned to its caller but not kept, it may have read the old follows
+
+
+class IdSet(object):
+    __slots__ = ('ids',)
+
+    def __init__(self, ids):
+        self.ids = array('q', sorted(ids))
+
+    def __contains__(self, id):
+        position = bisect_left(self.ids, id)
+        return position < len(self.ids) and self.ids[position] == id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+
+class FollowCache(object):
+    def __init__(self, loader, size, ttl, max_ids):
+        self.loader = loader #loader(user_id, limit) returns up to `limit` followed ids
+        self.size = size
+        self.ttl = ttl
+        self.max_ids = max_ids
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0 #bumped by every invalidation
+
+    #returns the IdSet of users followed by user_id, or None when the user follows too many people to cache
+    def get(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                return entry[1]
+            generation = self.generation
+        ids = list(self.loader(user_id, self.max_ids + 1))
+        id_set = IdSet(ids) if len(ids) <= self.max_ids else None
+        with self.lock:
+            if generation != self.generation:
+                return id_set
+            self.entries[user_id] = (now + self.ttl, id_set)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return id_set
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
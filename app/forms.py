@@ -1,6 +1,9 @@
+from flask import request
+from babel import Locale
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField
+from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField, SelectField
 from wtforms.validators import DataRequired, ValidationError, Email, EqualTo, Length
+from app import app
 from app.models import User
 from flask_babel import _, lazy_gettext as _l #wraps string in special object that triggers the translation to be performed later when the string is used
 
@@ -38,12 +41,16 @@ class RegistrationForm(FlaskForm):
 class EditProfileForm(FlaskForm):
     username = StringField(_l('Username'), validators=[DataRequired()])
     about_me = TextAreaField(_l('About me'), validators=[Length(min=0, max=140)]) #TextAreaField class is a milti-line box which the user can enter text. Length class is used to validate
+    locale = SelectField(_l('Language'))
     submit = SubmitField(_l('Submit'))
     
     #allows us to access the original username later when validating the form data
     def __init__(self, original_username, *args, **kwargs): #defines the constructor method for the EditProfileForm class, original_users is a parameter that we expect to be passed when creating an instance of the form
         super(EditProfileForm, self).__init__(*args, **kwargs) #calls the constrctor of the parent class 'FlaskForm' to initialize the forms basic functionality 
         self.original_username = original_username #sores the original_username parameter in an instance variable called original_username
+        #each supported language is listed under its own name; the empty choice keeps using the browser's language
+        self.locale.choices = [('', _('Browser default'))] + \
+            [(code, Locale.parse(code).display_name) for code in app.config['LANGUAGES']]
         
     #checks if the original_username has changed, sends query to database checing if the username exists
     def validate_username(self, username):
@@ -68,3 +75,14 @@ class ResetPasswordForm(FlaskForm):
     password2 = PasswordField(
         _l('Repeat Password'), validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField(_l('Request Password Reset'))
+
+#search form submitted with a GET request so results pages can be bookmarked; reads the query string and skips CSRF
+class SearchForm(FlaskForm):
+    q = StringField(_l('Search'), validators=[DataRequired()])
+
+    def __init__(self, *args, **kwargs):
+        if 'formdata' not in kwargs:
+            kwargs['formdata'] = request.args
+        if 'meta' not in kwargs:
+            kwargs['meta'] = {'csrf': False}
+        super(SearchForm, self).__init__(*args, **kwargs)
@@ -1,19 +1,133 @@
 from datetime import datetime
 from time import time
 from app import db, login, app
+from app.followcache import FollowCache
+from app.denylist import TokenDenylist
+from app.search import add_to_index, remove_from_index, query_index, reindex, register
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from hashlib import md5
+from functools import lru_cache
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.exc import IntegrityError
 import jwt
+from uuid import uuid4
+
+
+#generates MD5 hash with email then encodes the string as bytes before passing to hash function.
+#the same authors show up on every feed page, so digests are remembered instead of hashed on every render
+@lru_cache(maxsize=4096)
+def avatar_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+#URL of the gravatar image for a digest, scaled to the requested size in pixels
+def avatar_url(digest, size):
+    return f"https://www.gravatar.com/avatar/{digest}?d=retro&s={size}"
+
+
+#returns the insert() construct of the database in use. the SQLite and PostgreSQL versions support ON CONFLICT clauses
+def dialect_insert(table):
+    name = db.engine.dialect.name
+    if name == 'sqlite':
+        return sqlite.insert(table)
+    if name == 'postgresql':
+        return postgresql.insert(table)
+    return None
+
+
+#SQLite lets one writer in at a time. in WAL mode readers no longer wait for it, and busy_timeout makes a blocked
+#writer retry for a while instead of failing at once with 'database is locked'. set on every new connection
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA busy_timeout = {:d}'.format(app.config['SQLITE_BUSY_TIMEOUT']))
+    if app.config['SQLITE_WAL']:
+        #in-memory databases ignore the request and stay in 'memory' mode
+        cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.close()
+
+#only the application's own engine, and only when it is SQLite
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        db.event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
+
+#mixin that keeps a model's __searchable__ columns in the full text index (see app/search.py)
+class SearchableMixin(object):
+    #returns one page of matching objects ordered by relevance and recency, plus the cursor of the next page (None on the last page).
+    #hits that are no longer in the model's table are looked up in its archive tables and returned as archive objects
+    @classmethod
+    def search(cls, expression, cursor=None, per_page=10):
+        ids, next_cursor = query_index(cls.__tablename__, cls, expression, cursor, per_page)
+        if not ids:
+            return [], next_cursor
+        found = {obj.id: obj for obj in cls.query.filter(cls.id.in_(ids))}
+        for name in getattr(cls, '__search_archives__', ()):
+            missing = [id for id in ids if id not in found]
+            if not missing:
+                break
+            archive = next(mapper.class_ for mapper in db.Model.registry.mappers if mapper.local_table.name == name)
+            found.update((obj.id, obj) for obj in archive.query.filter(archive.id.in_(missing)))
+        return [found[id] for id in ids if id in found], next_cursor
+
+    #runs after every flush, when new objects have their ids, so the index is updated incrementally as posts are created
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        for obj in session.new:
+            if isinstance(obj, cls):
+                add_to_index(cls.__tablename__, obj, session)
+        for obj in session.dirty:
+            if isinstance(obj, cls) and any(
+                    db.inspect(obj).attrs[field].history.has_changes() for field in cls.__searchable__):
+                add_to_index(cls.__tablename__, obj, session)
+        for obj in session.deleted:
+            if isinstance(obj, cls):
+                remove_from_index(cls.__tablename__, obj, session)
+
+    #rebuilds the whole index from the table, used by the 'flask search reindex' command
+    @classmethod
+    def reindex(cls):
+        reindex(cls.__tablename__, cls)
 
 
 #Followers association table; used to create a many-to-many relationship between two instances of the User model
 #notice that it is not declared as a model, rather its just a means of storing foregin_keys
 followers = db.Table('followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')), #stores the ID of the user who is following another user
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')) #stores the ID of the user who is being followed by another user
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')), #stores the ID of the user who is being followed by another user
+    db.PrimaryKeyConstraint('follower_id', 'followed_id') #one row per pair, so concurrent follows cannot create duplicates
 )
 
+#loads the ids of the users followed by user_id for the follow cache, at most `limit` of them.
+#goes through session.query() so pending follows are flushed first, like the relationship query it replaces
+def load_followed_ids(user_id, limit):
+    return [id for id, in db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user_id).limit(limit)]
+
+followed_cache = FollowCache(load_followed_ids, app.config['FOLLOW_CACHE_SIZE'],
+                             app.config['FOLLOW_CACHE_TTL'], app.config['FOLLOW_CACHE_MAX_IDS'])
+
+
+#users whose follows the session changed. until the session commits their cache entries are not used by it (they
+#would miss its own changes) and not refilled from it (other requests would see uncommitted follows); the commit
+#or the rollback then drops just those entries
+def _follows_changed(session):
+    return session.info.setdefault('follows_changed', set())
+
+
+def _invalidate_changed_follows(session, *args):
+    for user_id in session.info.pop('follows_changed', ()):
+        followed_cache.invalidate(user_id)
+
+db.event.listen(db.session, 'after_commit', _invalidate_changed_follows)
+db.event.listen(db.session, 'after_soft_rollback', _invalidate_changed_follows)
+
+
+#single pair lookup through the primary key of followers
+def follows(follower_id, followed_id):
+    return db.session.query(db.exists().where(
+        followers.c.follower_id == follower_id, followers.c.followed_id == followed_id)).scalar()
+
 #inherits from db.Model, a base class for all models from Flask SQLAlchemy
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True) #defines field as class variable, created as instances of the db.Column class
@@ -23,6 +137,7 @@ class User(UserMixin, db.Model):
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    locale = db.Column(db.String(5)) #preferred language; None means negotiate it from the browser's Accept-Language header
 
     #Tells python how to print objects of this class
     def __repr__(self):
@@ -36,9 +151,7 @@ class User(UserMixin, db.Model):
     
     #method of user class that returns the URL of the user's avatar image, scaled to the requested size in pixels
     def avatar(self, size):
-        #generates MD5 hash with email then encodes the string as bytes before passing to hash function
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f"https://www.gravatar.com/avatar/{digest}?d=retro&s={size}"
+        return avatar_url(avatar_digest(self.email), size)
     
     #declars many-to-many relationship
     #followed represents the relationship attribute that will be used to access the users that the current user follows
@@ -52,23 +165,58 @@ class User(UserMixin, db.Model):
         backref=db.backref('followers', lazy='dynamic'), #sets up the backreference from the User instances in the followed relationship to the User instances in the followers relationship
         lazy='dynamic')#defines the loading stategy for the relationship. dynamic mean the relationship will return a query object instead of automatically loading the data. allows for further refine before executing
 
-    #follow method
+    #follow and unfollow are single statements that are safe to repeat and to race: the primary key on followers
+    #turns a second follow into a no-op instead of a duplicate row, and only the request whose statement actually
+    #changed a row counts the change in the rollups. both return True when they changed something
     def follow(self, user):
-        #checks if user is following the other user already
-        if not self.is_following(user):
-            #follows the user
-            self.followed.append(user)
-    #unfollow method
+        if self.id is None or user.id is None:
+            db.session.flush() #Core statements below do not autoflush, new users need their ids first
+        values = {'follower_id': self.id, 'followed_id': user.id}
+        insert = dialect_insert(followers)
+        if insert is not None:
+            changed = db.session.execute(insert.values(**values).on_conflict_do_nothing()).rowcount > 0
+        else:
+            #databases without ON CONFLICT: the primary key still rejects the duplicate, inside a savepoint
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(followers.insert().values(**values))
+                changed = True
+            except IntegrityError:
+                changed = False
+        if changed:
+            record_activity(user.id, new_followers=1)
+            _follows_changed(db.session()).add(self.id)
+        return changed
+
     def unfollow(self, user):
-        if self.is_following(user):
-            #remove the follow from the user
-            self.followed.remove(user)
+        if self.id is None or user.id is None:
+            db.session.flush()
+        changed = db.session.execute(followers.delete().where(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id)).rowcount > 0
+        if changed:
+            record_activity(user.id, new_followers=-1)
+            _follows_changed(db.session()).add(self.id)
+        return changed
+
     #supporting method to make sure the requested action makes sense (notice how is_following is used in the above methods)
     def is_following(self, user):
         #prevents dupilicate followers 
         #issues query on followed relationship to check if a link between two users already exists
-        #looks for items in the association table that have the left side foreign key set to the self user and the right side set to the user argument
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0 
+        #answered from the cached set of followed ids, so repeated checks while rendering a page cost no queries
+        #users that have not been flushed yet have no id, so they are flushed first
+        if self.id is None or user.id is None:
+            db.session.flush()
+        followed_ids = followed_cache.get(self.id) if self.id not in _follows_changed(db.session()) else None
+        if followed_ids is not None:
+            return user.id in followed_ids
+        #looks for the row in the association table that has the left side foreign key set to the self user and the right side set to the user argument
+        return follows(self.id, user.id)
+
+    #the reverse check, for the "follows you" badge: one lookup instead of loading all of user's follows into the cache
+    def is_followed_by(self, user):
+        if self.id is None or user.id is None:
+            db.session.flush()
+        return follows(user.id, self.id)
     
     #Query 1: Join -> first argument is followers and the second argument is the join condition 
     #has database creates a temporary table that combines data from posts and followers tables. Merged according to the condition passed as argument
@@ -81,6 +229,13 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id) #creates users own posts
         return followed.union(own).order_by(Post.timestamp.desc()) #return users posts and own posts
     
+    #returns the cached suggestions for this user, best first. reads the suggestion table only, never the follower graph
+    #users followed since the last build are dropped using the follow cache
+    def suggested_users(self, limit=5):
+        users = User.query.join(Suggestion, Suggestion.suggested_id == User.id).filter(
+            Suggestion.user_id == self.id).order_by(Suggestion.rank).limit(limit).all()
+        return [user for user in users if not self.is_following(user)]
+
     #This method returns a JWT (JSON Web Token) token as a string, which is generated directly by the jwt.encode() function
     def get_reset_password_token(self, expires_in=600):
         #jwt.encode() function take 3 main arguments the payload 
@@ -103,10 +258,53 @@ class User(UserMixin, db.Model):
         #if token verification is successful the method atempts to retrieve the User object associated with the user ID extraccted from the toke
         #gets user based on their id from the database
         return User.query.get(id)
-    
+
+    #short lived token for the JSON API (see app/api.py). it carries the id and username, so requests that send it
+    #are authenticated from the token alone, without loading the user
+    def get_access_token(self, expires_in=None):
+        now = time()
+        return jwt.encode(
+            {'sub': str(self.id), 'username': self.username, 'type': 'access', 'jti': uuid4().hex,
+             'iat': now, 'exp': now + (expires_in or app.config['API_TOKEN_EXPIRES'])},
+            app.config['SECRET_KEY'], algorithm='HS256'
+        )
+
+    #returns the token's claims, or None when it is invalid, expired or revoked. only queries the database when the
+    #process's copy of the denylist is due for a reload (see app/denylist.py)
+    @staticmethod
+    def verify_access_token(token):
+        try:
+            claims = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'],
+                                options={'require': ['sub', 'exp', 'iat', 'jti']})
+        except jwt.InvalidTokenError:
+            return
+        if claims.get('type') != 'access' or \
+                token_denylist.is_revoked(claims['jti'], int(claims['sub']), claims['iat']):
+            return
+        return claims
+
+
+#API token revocations (see app/denylist.py): a row has either the jti of one token or the user_id whose tokens
+#issued up to revoked_at are revoked. expires is when the tokens it covers have all expired and the row can go
+class RevokedToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(32))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    revoked_at = db.Column(db.Float, nullable=False)
+    expires = db.Column(db.Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<RevokedToken {}>'.format(self.jti or self.user_id)
+
+
+token_denylist = TokenDenylist(RevokedToken, app.config['API_TOKEN_EXPIRES'], app.config['API_TOKEN_DENYLIST_REFRESH'])
+
                     
 
-class Post(db.Model):
+class Post(SearchableMixin, db.Model):
+    __searchable__ = ['body']
+    __search_timestamp__ = 'timestamp'
+    __search_archives__ = ['post_archive'] #archived posts stay searchable
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -116,6 +314,74 @@ class Post(db.Model):
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+register(Post)
+
+
+#posts older than ARCHIVE_HORIZON_DAYS, moved here in batches by 'flask posts archive' (see app/archive.py) so the
+#post table and its indexes only hold the recent posts that nearly every page reads. ids are kept from the post table
+class PostArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    language = db.Column(db.String(5))
+
+    def __repr__(self):
+        return '<PostArchive {}>'.format(self.body)
+
+
+#precomputed who-to-follow suggestions, rebuilt offline by 'flask suggestions build' (see app/suggestions.py)
+#the (user_id, rank) primary key lets a page read a user's suggestions in order with a single index range scan
+class Suggestion(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    mutual_count = db.Column(db.Integer) #how many of the users followed by user_id also follow suggested_id
+
+    def __repr__(self):
+        return '<Suggestion {} -> {}>'.format(self.user_id, self.suggested_id)
+
+
+#per user activity counters bucketed by hour and by day. hourly rows are written as things happen and folded
+#into daily rows by 'flask rollups compact' (see app/rollups.py), so stats never need a GROUP BY over the post table
+class ActivityRollup(db.Model):
+    granularity = db.Column(db.String(4), primary_key=True) #'hour' or 'day'
+    bucket = db.Column(db.DateTime, primary_key=True) #start of the hour or day
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    posts = db.Column(db.Integer, nullable=False, default=0)
+    new_followers = db.Column(db.Integer, nullable=False, default=0) #follows minus unfollows
+    __table_args__ = (db.Index('ix_activity_rollup_user', 'user_id', 'granularity', 'bucket'),)
+
+    def __repr__(self):
+        return '<ActivityRollup {} {} {}>'.format(self.user_id, self.granularity, self.bucket)
+
+
+#adds to the counters of a rollup row, creating it if needed, as part of the caller's transaction
+def add_to_rollup(granularity, bucket, user_id, posts=0, new_followers=0):
+    table = ActivityRollup.__table__
+    insert = dialect_insert(table)
+    if insert is not None:
+        insert = insert.values(granularity=granularity, bucket=bucket, user_id=user_id,
+                               posts=posts, new_followers=new_followers)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=['granularity', 'bucket', 'user_id'],
+            set_={'posts': table.c.posts + insert.excluded.posts,
+                  'new_followers': table.c.new_followers + insert.excluded.new_followers}))
+        return
+    #databases without ON CONFLICT: try the update first and insert when there was no row to update
+    result = db.session.execute(table.update().where(
+        table.c.granularity == granularity, table.c.bucket == bucket, table.c.user_id == user_id).values(
+        posts=table.c.posts + posts, new_followers=table.c.new_followers + new_followers))
+    if result.rowcount == 0:
+        db.session.execute(table.insert().values(granularity=granularity, bucket=bucket, user_id=user_id,
+                                                 posts=posts, new_followers=new_followers))
+
+
+#records posts or follower changes for a user in the current hour
+def record_activity(user_id, posts=0, new_followers=0, when=None):
+    when = when or datetime.utcnow()
+    add_to_rollup('hour', when.replace(minute=0, second=0, microsecond=0), user_id, posts, new_followers)
+
 
 #load a user given the ID
 #nessary for flask-login to work with database
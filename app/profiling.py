@@ -0,0 +1,170 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+import jwt
+from flask import request, g, abort, render_template, Response
+from flask_login import current_user, login_required
+from app import app
+
+#on-demand profiling of single requests in production. a request is profiled when it carries a profile token
+#(minted with 'flask profile token') in the X-Profile-Token header or the ?profile= query argument, or when an
+#admin (an email in ADMINS) adds ?profile=1. the profile is saved in PROFILE_DIR under the view's name and
+#listed at /admin/profiles. PROFILE_MODE chooses the profiler:
+#  cprofile -> deterministic, every call is timed; saved as a pstats .prof file (snakeviz, pstats)
+#  sample   -> a thread records the request's stack every PROFILE_INTERVAL seconds; saved as collapsed stacks
+#              (.collapsed, the input of flamegraph.pl and speedscope), with far less overhead on the request
+#requests that do not ask for a profile only pay for one argument and one header lookup.
+#under gevent or eventlet workers (see serve.py) every request of a worker is a greenlet on the same OS thread.
+#the sampler cannot see a greenlet's stack there (the sampling thread is itself a greenlet that only runs when the
+#request waits), so sample mode refuses and says so in an X-Profile-Error header. cProfile still works, but while
+#the request waits for I/O it also times the other greenlets that run in the meantime
+
+PROFILE_HEADER = 'X-Profile-Token'
+MODES = {'cprofile': '.prof', 'sample': '.collapsed'}
+_name_re = re.compile(r'^[\w.-]+$')
+
+
+def get_profile_token(expires_in=3600):
+    return jwt.encode({'profile': True, 'exp': time.time() + expires_in}, app.config['SECRET_KEY'], algorithm='HS256')
+
+
+def verify_profile_token(token):
+    try:
+        return jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256']).get('profile') is True
+    except jwt.InvalidTokenError:
+        return False
+
+
+def _is_admin():
+    return current_user.is_authenticated and current_user.email in app.config['ADMINS']
+
+
+#'gevent' or 'eventlet' when threads were monkey-patched into greenlets, None otherwise
+def _green_threads():
+    gevent = sys.modules.get('gevent.monkey')
+    if gevent is not None and gevent.is_module_patched('threading'):
+        return 'gevent'
+    eventlet = sys.modules.get('eventlet.patcher')
+    if eventlet is not None and eventlet.is_monkey_patched('thread'):
+        return 'eventlet'
+    return None
+
+
+def _requested():
+    flag = request.args.get('profile') or request.headers.get(PROFILE_HEADER)
+    if not flag:
+        return False
+    return (flag == '1' and _is_admin()) or verify_profile_token(flag)
+
+
+class Sampler(object):
+    #records the stack of one thread, root first, the way flamegraph.pl expects it
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append('{} ({}:{})'.format(
+                    code.co_name, os.path.join(*code.co_filename.split(os.sep)[-2:]), code.co_firstlineno))
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join(reversed(frames))] += 1
+
+    def enable(self):
+        self.thread.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+#runs before every other before_request handler so they are part of the profile
+def start_profile():
+    if not _requested():
+        return
+    mode = app.config['PROFILE_MODE']
+    green = _green_threads() if mode == 'sample' else None
+    if green:
+        g.profile_error = 'sample mode cannot profile {} workers, use PROFILE_MODE=cprofile'.format(green)
+        return
+    if mode == 'sample':
+        profiler = Sampler(threading.get_ident(), app.config['PROFILE_INTERVAL'])
+    else:
+        profiler = cProfile.Profile()
+    g.profile_name = '{}-{}{}'.format(time.strftime('%Y%m%dT%H%M%S'), request.endpoint or 'unknown', MODES[mode])
+    g.profiler = profiler
+    profiler.enable()
+
+
+app.before_request_funcs.setdefault(None, []).insert(0, start_profile)
+
+
+@app.after_request
+def add_profile_header(response):
+    if 'profiler' in g:
+        response.headers['X-Profile'] = g.profile_name
+    elif 'profile_error' in g:
+        response.headers['X-Profile-Error'] = g.profile_error
+    return response
+
+
+@app.teardown_request
+def save_profile(exception=None):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], g.profile_name))
+
+
+def _profiles():
+    directory = app.config['PROFILE_DIR']
+    if not os.path.isdir(directory):
+        return []
+    return sorted((name for name in os.listdir(directory) if name.endswith(tuple(MODES.values()))), reverse=True)
+
+
+@app.route('/admin/profiles')
+@login_required
+def profiles():
+    if not _is_admin():
+        abort(403)
+    return render_template('profiles.html', profiles=_profiles())
+
+
+#a .prof file as the pstats report sorted by cumulative time, a .collapsed file as is (most frequent stacks first)
+@app.route('/admin/profiles/<name>')
+@login_required
+def profile(name):
+    if not _is_admin():
+        abort(403)
+    if not _name_re.match(name) or name not in _profiles():
+        abort(404)
+    path = os.path.join(app.config['PROFILE_DIR'], name)
+    if name.endswith('.prof'):
+        report = io.StringIO()
+        pstats.Stats(path, stream=report).sort_stats('cumulative').print_stats(app.config['PROFILE_LINES'])
+        return Response(report.getvalue(), mimetype='text/plain')
+    with open(path) as f:
+        return Response(f.read(), mimetype='text/plain')
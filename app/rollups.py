@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+from app import app, db
+from app.bulk import iter_rows
+from app.models import Post, PostArchive, ActivityRollup, add_to_rollup
+
+#read side and maintenance of the activity rollups written by record_activity() in app/models.py.
+#recent activity lives in hourly rows; 'flask rollups compact' periodically folds hourly rows older than
+#ROLLUP_HOURLY_RETENTION into daily rows, so both tables stay small and every read below is a short index range scan
+
+HOUR = 'hour'
+DAY = 'day'
+
+
+def _day(when):
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+#users ranked by recent activity in the rollups: new followers count more than posting.
+#when the window reaches back past ROLLUP_HOURLY_RETENTION its older part is only in daily rows, which are read
+#from the day the window starts
+def trending_authors(hours=None, limit=10):
+    now = datetime.utcnow()
+    since = now - timedelta(hours=hours or app.config['TRENDING_HOURS'])
+    window = db.and_(ActivityRollup.granularity == HOUR, ActivityRollup.bucket >= since)
+    if since < now - timedelta(hours=app.config['ROLLUP_HOURLY_RETENTION']):
+        window = db.or_(window, db.and_(ActivityRollup.granularity == DAY, ActivityRollup.bucket >= _day(since)))
+    score = db.func.sum(ActivityRollup.posts) + \
+        app.config['TRENDING_FOLLOWER_WEIGHT'] * db.func.sum(ActivityRollup.new_followers)
+    rows = db.session.query(ActivityRollup.user_id, score.label('score')).filter(window).group_by(
+        ActivityRollup.user_id).having(score > 0).order_by(db.desc('score'), ActivityRollup.user_id).limit(limit)
+    return [row.user_id for row in rows]
+
+
+#posts and new followers per day for the last `days` days (oldest first), from daily rows plus not yet compacted hourly rows
+def user_activity(user_id, days=7):
+    first = _day(datetime.utcnow()) - timedelta(days=days - 1)
+    totals = {first + timedelta(days=n): [0, 0] for n in range(days)}
+    rows = ActivityRollup.query.filter(ActivityRollup.user_id == user_id, ActivityRollup.bucket >= first)
+    for row in rows:
+        counts = totals.get(_day(row.bucket))
+        if counts is not None:
+            counts[0] += row.posts
+            counts[1] += row.new_followers
+    return [(day, counts[0], counts[1]) for day, counts in sorted(totals.items())]
+
+
+#folds hourly rows older than the retention window into daily rows, one batch per transaction so locks stay short
+def compact(batch_size=1000, retention=None):
+    cutoff = datetime.utcnow() - timedelta(hours=retention or app.config['ROLLUP_HOURLY_RETENTION'])
+    compacted = 0
+    while True:
+        rows = ActivityRollup.query.filter(
+            ActivityRollup.granularity == HOUR, ActivityRollup.bucket < cutoff).order_by(
+            ActivityRollup.bucket, ActivityRollup.user_id).limit(batch_size).all()
+        if not rows:
+            return compacted
+        daily = {}
+        for row in rows:
+            counts = daily.setdefault((_day(row.bucket), row.user_id), [0, 0])
+            counts[0] += row.posts
+            counts[1] += row.new_followers
+            db.session.delete(row)
+        for (day, user_id), (posts, new_followers) in daily.items():
+            add_to_rollup(DAY, day, user_id, posts, new_followers)
+        db.session.commit()
+        compacted += len(rows)
+
+
+#recreates the post counters from the post and archive tables, for installs that had posts before rollups existed
+#and after bulk imports. the counters are zeroed and recounted in one transaction, so readers see either the old or
+#the new counts, never zero. follows have no timestamp, so follower counters can only be collected from the moment
+#rollups are enabled
+def rebuild(chunk_size=5000):
+    ActivityRollup.query.filter(ActivityRollup.posts != 0).update({'posts': 0})
+    pending = {}
+    for table in (Post.__table__, PostArchive.__table__):
+        for row in iter_rows(table, ['id'], chunk_size):
+            if row['user_id'] is None or row['timestamp'] is None:
+                continue
+            key = (row['timestamp'].replace(minute=0, second=0, microsecond=0), row['user_id'])
+            pending[key] = pending.get(key, 0) + 1
+            if len(pending) >= chunk_size:
+                _flush_posts(pending)
+    _flush_posts(pending)
+    db.session.commit()
+    return compact()
+
+
+def _flush_posts(pending):
+    for (hour, user_id), posts in pending.items():
+        add_to_rollup(HOUR, hour, user_id, posts=posts)
+    pending.clear()
@@ -1,12 +1,15 @@
-from flask import render_template, flash, redirect, url_for, request, g,jsonify
-from app.models import User, Post
+from flask import render_template, flash, redirect, url_for, request, g,jsonify, Response, abort
+from app.models import User, Post, record_activity, followed_cache, load_followed_ids, token_denylist
+from app.rollups import trending_authors, user_activity
+from app import feeds
+from app.stream import get_broker, publish_post, user_channel, events
 from app import app, db
-from app.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm
+from app.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm, SearchForm
 from app.email import send_password_reset_email
 from app.translate import translate
 from flask_login import current_user, login_user, logout_user, login_required
 from werkzeug.urls import url_parse
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask_babel import _, get_locale
 from langdetect import detect, LangDetectException
 
@@ -26,18 +29,20 @@ def index():
         post = Post(body=form.post.data, author=current_user, language=language)
         #add the newly created post to the database
         db.session.add(post)
+        #count the post in the author's hourly activity, in the same transaction as the post itself
+        record_activity(current_user.id, posts=1)
         #commit any changes made
         db.session.commit()
+        #push the new post to the open /stream connections of the author's followers
+        publish_post(post)
         flash(_('Your post is now live!'))
         return redirect(url_for('index')) #Good practice to redirect although the page will subsquently already render the template when returned. (POST/redirect/GET pattern)
                                          #By redirecting, it avoids inserting duplicate posts when a user inadvertently refreshes the page after submitting a web form
     #accesses arguments given in query string using Flask's request args object (determines the page)
     page = request.args.get('page', 1, type=int)
-    #gets all the followed posts for the current user using the followed_posts() method created in the User class. 
-    #uses the Flask SQLAlechemy paginate() method to retrieve only the desired page of results. 
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False
-    )
+    #gets the followed posts for the current user as lightweight rows (see app/feeds.py), same posts as the followed_posts() method created in the User class.
+    #paginate() retrieves only the desired page of results.
+    posts = feeds.paginate(feeds.followed_feed(current_user.id), page, app.config['POSTS_PER_PAGE'])
     
    #find the next page and prevous pages using more of flask SQLAlchemy Pagination attributes
    #**interesting** you can add any keyword argument to url_for() function and if those arguments are not referenced in the URL directly, then Flask will incle them
@@ -47,7 +52,9 @@ def index():
     prev_url = url_for('index', page=posts.prev_num) \
         if posts.has_prev else None
     
-    return render_template('index.html',title=_('Home'), form=form, posts=posts.items, next_url=next_url, prev_url=prev_url) 
+    #who-to-follow suggestions are precomputed offline, so this is a single read of the suggestion table
+    suggestions = current_user.suggested_users(app.config['SUGGESTIONS_SHOWN'])
+    return render_template('index.html',title=_('Home'), form=form, posts=posts.items, next_url=next_url, prev_url=prev_url, suggestions=suggestions) 
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -108,8 +115,7 @@ def register():
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
+    posts = feeds.paginate(feeds.user_feed(user.id), page, app.config['POSTS_PER_PAGE'])
     
     #**backslashes improve readability**
     #pagination links generated by the url_for() need the extra username argument because they are pointing back the user profile page which has this username as a dynamic component of the URL
@@ -119,16 +125,24 @@ def user(username):
         if posts.has_prev else None
         
     form = EmptyForm() #instantiates EmptyForm object
-    return render_template('user.html', user=user, form=form, posts=posts.items, next_url=next_url, prev_url=prev_url)
+    activity = user_activity(user.id)
+    #suggestions are only shown to the owner of the profile
+    suggestions = current_user.suggested_users(app.config['SUGGESTIONS_SHOWN']) if user == current_user else []
+    return render_template('user.html', user=user, form=form, posts=posts.items, next_url=next_url, prev_url=prev_url, suggestions=suggestions, activity=activity)
 
 #executed before any view function is called; updates the last seen attribute of the authenticated user
 @app.before_request
 def before_request():
     #checks if the user is authenticated
     if current_user.is_authenticated:
-        #updates the last_seen attribute of the current user.
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        #updates the last_seen attribute of the current user. a write on every request queues every page view
+        #behind the database's write lock, so it is only written once it is LAST_SEEN_UPDATE_INTERVAL seconds old
+        now = datetime.utcnow()
+        if current_user.last_seen is None or \
+                (now - current_user.last_seen).total_seconds() >= app.config['LAST_SEEN_UPDATE_INTERVAL']:
+            current_user.last_seen = now
+            db.session.commit()
+        g.search_form = SearchForm()
         g.locale = str(get_locale())
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
@@ -142,6 +156,7 @@ def edit_profile():
         current_user.username = form.username.data
         #updates the about_me attribute of the current_user object with the data submitted in the form's about_me field
         current_user.about_me = form.about_me.data
+        current_user.locale = form.locale.data or None
         db.session.commit()
         flash(_('Your changes have been saved'))
         return redirect(url_for('edit_profile'))
@@ -149,6 +164,7 @@ def edit_profile():
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
+        form.locale.data = current_user.locale or ''
     return render_template('edit_profile.html', title='Edit Profile', form=form)
 
 @app.route('/follow/<username>', methods=['POST'])
@@ -194,12 +210,58 @@ def unfollow(username):
 @login_required
 def explore():
     page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False
-    )
+    posts = feeds.paginate(feeds.explore_feed(), page, app.config['POSTS_PER_PAGE'])
     #**NOTICE** that index.html template is bing re-used only the form is not being passed because I don't want users to be able to write blog posts here 
     return render_template('index.html', title=_('Explore'), posts=posts.items)
 
+#the channels of the users user_id follows and their own. also called by the open stream after the request
+#context is gone, so it runs in an app context of its own and gives the database connection back straight away
+def stream_channels(user_id):
+    with app.app_context():
+        followed_ids = followed_cache.get(user_id)
+        if followed_ids is None:
+            followed_ids = load_followed_ids(user_id, None)
+        db.session.remove()
+    return [user_channel(id) for id in followed_ids] + [user_channel(user_id)]
+
+#Server-Sent Events stream announcing new posts from followed users (and the user's own posts) to the home page
+@app.route('/stream')
+@login_required
+def stream():
+    if not app.config['STREAM_ENABLED']:
+        abort(404)
+    user_id = current_user.id
+    subscription = get_broker().subscribe(stream_channels(user_id))
+    #the stream stays open for a long time, so give the database connection back to the pool first
+    db.session.remove()
+    return Response(events(subscription, lambda: stream_channels(user_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+#recent posts from the most active authors, ranked from the hourly activity rollups
+@app.route('/trending')
+@login_required
+def trending():
+    page = request.args.get('page', 1, type=int)
+    since = datetime.utcnow() - timedelta(hours=app.config['TRENDING_HOURS'])
+    posts = feeds.paginate(feeds.trending_feed(trending_authors(), since), page, app.config['POSTS_PER_PAGE'])
+    next_url = url_for('trending', page=posts.next_num) \
+        if posts.has_next else None
+    prev_url = url_for('trending', page=posts.prev_num) \
+        if posts.has_prev else None
+    return render_template('index.html', title=_('Trending'), posts=posts.items, next_url=next_url, prev_url=prev_url)
+
+#full text search over posts; pages are walked with the opaque cursor returned by the search index instead of page numbers
+@app.route('/search')
+@login_required
+def search():
+    if not g.search_form.validate():
+        return redirect(url_for('explore'))
+    cursor = request.args.get('cursor')
+    posts, next_cursor = feeds.search_feed(g.search_form.q.data, cursor, app.config['POSTS_PER_PAGE'])
+    next_url = url_for('search', q=g.search_form.q.data, cursor=next_cursor) \
+        if next_cursor else None
+    return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url)
+
 @app.route("/reset_password_request", methods=["GET", "POST"])
 def reset_password_request():
     #check if the user is logged in
@@ -228,6 +290,7 @@ def reset_password(token):
     form = ResetPasswordForm()
     if form.validate_on_submit():
         user.set_password(form.password.data) #invoke the set_password() method of the User class to change the password
+        token_denylist.revoke_user(user.id) #API tokens issued with the old password stop working
         db.session.commit()
         flash(_('Your password has been reset.'))
         return redirect(url_for('login'))
@@ -0,0 +1,264 @@
+import math
+import re
+import threading
+from collections import defaultdict
+from datetime import datetime
+from app import app, db
+
+#full text search over models that declare a __searchable__ list of columns.
+#two interchangeable backends are provided:
+#  fts5   -> a SQLite FTS5 virtual table named <tablename>_fts kept in the same database (default on SQLite)
+#  memory -> an in-process inverted index rebuilt from the database on first use (any database)
+#the rest of the application only talks to the module level functions at the bottom of this file.
+#a model can name archive tables in __search_archives__: rows moved there keep their id and stay searchable
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+#recency is measured in days since a fixed epoch (not since "now") so that scores, and therefore cursors, stay stable between requests
+_epoch = datetime(2000, 1, 1)
+
+
+def tokenize(text):
+    return [token.lower() for token in _token_re.findall(text or '')]
+
+
+def _days(timestamp):
+    return (timestamp - _epoch).total_seconds() / 86400.0 if timestamp else 0.0
+
+
+#a keyset cursor is the (score, id) pair of the last result on the page. repr() round trips floats exactly
+def encode_cursor(score, id):
+    return '{!r}:{}'.format(score, id)
+
+
+def decode_cursor(cursor):
+    try:
+        score, id = cursor.rsplit(':', 1)
+        return float(score), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+#the tables a model's indexed rows live in: its own table first, then its archive tables
+def _tables(model_class):
+    return [model_class.__table__] + [db.metadata.tables[name] for name in getattr(model_class, '__search_archives__', ())]
+
+
+class FTS5Backend(object):
+    #rows are written inside the flush that creates the post, so the index commits or rolls back together with it
+
+    def ddl(self, index, fields):
+        return 'CREATE VIRTUAL TABLE IF NOT EXISTS {}_fts USING fts5({})'.format(index, ', '.join(fields))
+
+    def add(self, index, model, session):
+        connection = session.connection()
+        connection.execute(db.text('DELETE FROM {}_fts WHERE rowid = :id'.format(index)), {'id': model.id})
+        fields = model.__searchable__
+        connection.execute(
+            db.text('INSERT INTO {0}_fts(rowid, {1}) VALUES (:id, {2})'.format(
+                index, ', '.join(fields), ', '.join(':' + field for field in fields))),
+            dict({field: getattr(model, field) for field in fields}, id=model.id))
+
+    def remove(self, index, model, session):
+        session.connection().execute(db.text('DELETE FROM {}_fts WHERE rowid = :id'.format(index)), {'id': model.id})
+
+    def query(self, index, model_class, expression, cursor, per_page):
+        tokens = tokenize(expression)
+        if not tokens:
+            return [], None
+        #every token is quoted so user input can never be parsed as FTS5 query syntax; adjacent phrases are ANDed
+        match = ' '.join('"{}"'.format(token) for token in tokens)
+        after = decode_cursor(cursor)
+        #the timestamp comes from whichever table holds the row; index rows whose row is gone are skipped
+        tables = [table.name for table in _tables(model_class)]
+        timestamps = ['{}.{}'.format(table, model_class.__search_timestamp__) for table in tables]
+        timestamp = timestamps[0] if len(timestamps) == 1 else 'COALESCE({})'.format(', '.join(timestamps))
+        sql = ('SELECT id, score FROM ('
+               ' SELECT {0}_fts.rowid AS id, -bm25({0}_fts) + :weight * (julianday({1}) - julianday(:epoch)) AS score'
+               ' FROM {0}_fts {2} WHERE {0}_fts MATCH :match AND {1} IS NOT NULL)'
+               ' WHERE :after_score IS NULL OR score < :after_score OR (score = :after_score AND id < :after_id)'
+               ' ORDER BY score DESC, id DESC LIMIT :limit').format(
+            index, timestamp, ' '.join('LEFT JOIN {0} ON {0}.id = {1}_fts.rowid'.format(table, index) for table in tables))
+        rows = db.session.execute(db.text(sql), {
+            'weight': app.config['SEARCH_RECENCY_WEIGHT'], 'epoch': _epoch.isoformat(' '), 'match': match,
+            'after_score': after[0] if after else None, 'after_id': after[1] if after else None,
+            'limit': per_page + 1}).fetchall()
+        return _page(rows, per_page)
+
+    def reindex(self, index, model_class):
+        fields = ', '.join(model_class.__searchable__)
+        db.session.execute(db.text('DELETE FROM {}_fts'.format(index)))
+        for table in _tables(model_class):
+            db.session.execute(db.text('INSERT INTO {0}_fts(rowid, {1}) SELECT id, {1} FROM {2}'.format(
+                index, fields, table.name)))
+        db.session.commit()
+
+
+class MemoryBackend(object):
+    #postings map each term to {document id: term frequency}; documents map id -> (length, recency in days, terms).
+    #changes are staged on the session and only applied after a successful commit.
+    #each process holds its own copy, so in a multi-worker deployment other workers only see new posts after a reindex
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.postings = {}
+        self.documents = {}
+        self.lengths = {}
+        self.loaded = set()
+
+    def clear(self, index=None):
+        with self.lock:
+            for name in ([index] if index else list(self.postings)):
+                self.postings.pop(name, None)
+                self.documents.pop(name, None)
+                self.lengths.pop(name, None)
+                self.loaded.discard(name)
+
+    def _index_document(self, index, id, text, timestamp):
+        postings = self.postings.setdefault(index, defaultdict(dict))
+        documents = self.documents.setdefault(index, {})
+        self._unindex_document(index, id)
+        tokens = tokenize(text)
+        for token in tokens:
+            postings[token][id] = postings[token].get(id, 0) + 1
+        documents[id] = (len(tokens), _days(timestamp), tuple(set(tokens)))
+        self.lengths[index] = self.lengths.get(index, 0) + len(tokens)
+
+    def _unindex_document(self, index, id):
+        document = self.documents.get(index, {}).pop(id, None)
+        if document is not None:
+            self.lengths[index] -= document[0]
+            postings = self.postings[index]
+            for token in document[2]:
+                postings[token].pop(id, None)
+                if not postings[token]:
+                    del postings[token]
+
+    def _text(self, model):
+        return ' '.join(getattr(model, field) or '' for field in model.__searchable__)
+
+    def add(self, index, model, session):
+        session.info.setdefault('search_pending', []).append(
+            ('add', index, model.id, self._text(model), getattr(model, model.__search_timestamp__)))
+
+    def remove(self, index, model, session):
+        session.info.setdefault('search_pending', []).append(('remove', index, model.id, None, None))
+
+    def after_commit(self, session):
+        pending = session.info.pop('search_pending', [])
+        with self.lock:
+            for action, index, id, text, timestamp in pending:
+                if index not in self.loaded:
+                    continue #the index is built from the database on first query, which already includes this change
+                if action == 'add':
+                    self._index_document(index, id, text, timestamp)
+                else:
+                    self._unindex_document(index, id)
+
+    def after_rollback(self, session):
+        session.info.pop('search_pending', None)
+
+    def query(self, index, model_class, expression, cursor, per_page):
+        tokens = set(tokenize(expression))
+        if not tokens:
+            return [], None
+        with self.lock:
+            if index not in self.loaded:
+                self.reindex(index, model_class)
+            postings = self.postings.get(index, {})
+            documents = self.documents.get(index, {})
+            lists = [postings.get(token) for token in tokens]
+            if not all(lists):
+                return [], None
+            lists.sort(key=len)
+            candidates = set(lists[0])
+            for posting in lists[1:]:
+                candidates.intersection_update(posting)
+            total = len(documents)
+            average = self.lengths.get(index, 0) / float(total or 1) or 1.0
+            weight = app.config['SEARCH_RECENCY_WEIGHT']
+            scored = []
+            for id in candidates:
+                length, days = documents[id][:2]
+                score = weight * days
+                for posting in lists:
+                    tf = posting[id]
+                    idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+                    score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / average))
+                scored.append((score, id))
+        after = decode_cursor(cursor)
+        if after:
+            scored = [row for row in scored if row < after]
+        scored.sort(reverse=True)
+        return _page([(id, score) for score, id in scored[:per_page + 1]], per_page)
+
+    def reindex(self, index, model_class):
+        with self.lock:
+            self.clear(index)
+            self.postings[index] = defaultdict(dict)
+            self.documents[index] = {}
+            for table in _tables(model_class):
+                columns = [table.c.id, table.c[model_class.__search_timestamp__]] + \
+                    [table.c[field] for field in model_class.__searchable__]
+                for row in db.session.execute(db.select(*columns)).yield_per(10000):
+                    self._index_document(index, row[0], ' '.join(text or '' for text in row[2:]), row[1])
+            self.loaded.add(index)
+
+
+def _page(rows, per_page):
+    #one extra row is fetched to find out if there is another page without counting the matches
+    #rows are (id, score) pairs
+    ids = [row[0] for row in rows[:per_page]]
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = encode_cursor(rows[per_page - 1][1], rows[per_page - 1][0])
+    return ids, next_cursor
+
+
+_backends = {}
+
+
+def get_backend():
+    name = app.config['SEARCH_BACKEND'] or \
+        ('fts5' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') else 'memory')
+    if name not in _backends:
+        _backends[name] = FTS5Backend() if name == 'fts5' else MemoryBackend()
+        if name == 'memory':
+            db.event.listen(db.session, 'after_commit', _backends[name].after_commit)
+            db.event.listen(db.session, 'after_rollback', _backends[name].after_rollback)
+    return _backends[name]
+
+
+def add_to_index(index, model, session):
+    get_backend().add(index, model, session)
+
+
+def remove_from_index(index, model, session):
+    get_backend().remove(index, model, session)
+
+
+def query_index(index, model_class, expression, cursor=None, per_page=10):
+    return get_backend().query(index, model_class, expression, cursor, per_page)
+
+
+def reindex(index, model_class):
+    get_backend().reindex(index, model_class)
+
+
+#creates (and drops) the FTS5 table together with the model's own table so db.create_all()/drop_all() keep them in step
+def register(model_class):
+    table = model_class.__table__
+    backend = FTS5Backend()
+    db.event.listen(table, 'after_create',
+                    db.DDL(backend.ddl(table.name, model_class.__searchable__)).execute_if(dialect='sqlite'))
+    db.event.listen(table, 'before_drop',
+                    db.DDL('DROP TABLE IF EXISTS {}_fts'.format(table.name)).execute_if(dialect='sqlite'))
+    db.event.listen(table, 'after_drop', lambda *args, **kwargs: _clear_memory(table.name))
+    db.event.listen(db.session, 'after_flush', model_class.after_flush)
+
+
+def _clear_memory(index):
+    if 'memory' in _backends:
+        _backends['memory'].clear(index)
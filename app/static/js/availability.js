@@ -0,0 +1,38 @@
+//checks the username field of the registration form against /availability while it is typed.
+//the URL and the messages are rendered by register.html as data attributes on the form's column
+$(function () {
+  var settings = $("[data-availability-url]");
+  if (!settings.length) {
+    return;
+  }
+  $.each(["username"], function (i, field) {
+    var input = $("#" + field);
+    var help = $('<span class="help-block"></span>').insertAfter(input).hide();
+    var timer = null;
+    var checked = "";
+    input.on("input", function () {
+      clearTimeout(timer);
+      //waits for a pause in typing so a request is not sent for every key
+      timer = setTimeout(function () {
+        var value = $.trim(input.val());
+        if (value === checked) {
+          return;
+        }
+        checked = value;
+        if (!value) {
+          help.hide();
+          return;
+        }
+        var query = {};
+        query[field] = value;
+        $.getJSON(settings.data("availability-url"), query).done(function (response) {
+          if (response.value !== checked) {
+            return; //an answer to an older value arriving late
+          }
+          help.text(response.available ? "" : settings.data("taken-" + field)).toggle(!response.available);
+          input.closest(".form-group").toggleClass("has-error", !response.available);
+        });
+      }, 300);
+    });
+  });
+});
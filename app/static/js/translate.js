@@ -0,0 +1,20 @@
+//replaces the content of destElem with image tag displaying a loading indicator
+//the URLs and the error message are rendered by base.html as data attributes on <body>
+function translate(sourceElem, destElem, sourceLang, destLang) {
+  var settings = document.body.dataset;
+  $(destElem).html('<img src="' + settings.loadingImage + '">');
+  //uses jQuery $.post method to send an AJAX POST request to the URL /translate data sent includes original text, source language, and destination language
+  $.post(settings.translateUrl, {
+    text: $(sourceElem).text(),
+    source_language: sourceLang,
+    dest_language: destLang,
+  })
+    .done(function (response) {
+      //if the POST request is successful the .done callback is executed.
+      $(destElem).text(response["text"]); //the translated text received from the server response is set as the content of destElem
+    })
+    .fail(function () {
+      //if the POST request fails
+      $(destElem).text(settings.translateError); //destElem is set to display an error message
+    });
+}
@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+from collections import deque
+from importlib import import_module
+from app import app
+
+#publish/subscribe fan-out behind the /stream Server-Sent Events endpoint. new posts are published on the
+#channel of their author ('user:<id>') and every open stream subscribes to the channels of the users it follows.
+#the broker class is chosen with STREAM_BROKER ('module:Class'). LocalBroker only reaches streams served by the
+#same process, so serve.py refuses it with more than one worker; RedisBroker relays every post through Redis
+#pub/sub to the LocalBroker of each process. another pub/sub service can be dropped in with the same four methods.
+#an open stream re-reads the followed users every STREAM_HEARTBEAT seconds and moves its subscription along.
+#waiting streams block on a threading.Event, which gevent turns into a cheap greenlet switch, so under the gevent
+#worker class thousands of idle connections do not each hold an OS thread. under sync or gthread workers every open
+#stream would hold a whole worker thread, which is why serve.py refuses them unless STREAM_ENABLED is off
+
+
+class Subscription(object):
+    __slots__ = ('channels', 'messages', 'ready')
+
+    def __init__(self, channels, size):
+        self.channels = channels
+        #a client that stops reading only ever holds the newest `size` messages
+        self.messages = deque(maxlen=size)
+        self.ready = threading.Event()
+
+    def put(self, message):
+        self.messages.append(message)
+        self.ready.set()
+
+    #waits up to timeout seconds and returns the pending messages, an empty list when nothing arrived
+    def get(self, timeout):
+        self.ready.wait(timeout)
+        self.ready.clear()
+        messages = []
+        while self.messages:
+            messages.append(self.messages.popleft())
+        return messages
+
+
+class LocalBroker(object):
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channels):
+        subscription = Subscription(channels, app.config['STREAM_QUEUE_SIZE'])
+        with self.lock:
+            for channel in channels:
+                self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    #moves a subscription to a new set of channels, e.g. after the user followed someone
+    def update(self, subscription, channels):
+        with self.lock:
+            for channel in set(subscription.channels) - set(channels):
+                subscribers = self.channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.channels[channel]
+            for channel in channels:
+                self.channels.setdefault(channel, set()).add(subscription)
+            subscription.channels = channels
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscribers = self.channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.channels[channel]
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(message)
+
+
+#publishes through Redis (pip install redis, STREAM_REDIS_URL). every process runs one listener thread (a greenlet
+#under gevent) on the pattern of all user channels and hands what arrives to its own streams
+class RedisBroker(LocalBroker):
+    def __init__(self):
+        import redis
+        super(RedisBroker, self).__init__()
+        self.redis = redis.Redis.from_url(app.config['STREAM_REDIS_URL'])
+        self.listener = threading.Thread(target=self._listen, daemon=True)
+        self.listener.start()
+
+    def _listen(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(user_channel('*'))
+        for message in pubsub.listen():
+            LocalBroker.publish(self, message['channel'].decode(), message['data'].decode())
+
+    def publish(self, channel, message):
+        self.redis.publish(channel, message)
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        module, name = app.config['STREAM_BROKER'].split(':')
+        _broker = getattr(import_module(module), name)()
+    return _broker
+
+
+def user_channel(user_id):
+    return 'user:{}'.format(user_id)
+
+
+def publish_post(post):
+    get_broker().publish(user_channel(post.user_id), json.dumps({
+        'id': post.id, 'author': post.author.username, 'body': post.body}))
+
+
+#generator producing the text/event-stream body for a subscription until the client disconnects.
+#channels, when given, returns the channels the stream should be on and is called once per heartbeat interval
+def events(subscription, channels=None):
+    broker = get_broker()
+    checked = time.monotonic()
+    try:
+        yield 'retry: {}\n\n'.format(app.config['STREAM_RETRY_MS'])
+        while True:
+            messages = subscription.get(app.config['STREAM_HEARTBEAT'])
+            if channels is not None and time.monotonic() - checked >= app.config['STREAM_HEARTBEAT']:
+                checked = time.monotonic()
+                current = channels()
+                if set(current) != set(subscription.channels):
+                    broker.update(subscription, current)
+            if not messages:
+                #a comment line keeps proxies from closing an idle connection and surfaces disconnected clients
+                yield ': keep-alive\n\n'
+            for message in messages:
+                yield 'event: post\ndata: {}\n\n'.format(message)
+    finally:
+        broker.unsubscribe(subscription)
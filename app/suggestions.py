@@ -0,0 +1,80 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from app import app, db
+from app.bulk import iter_rows
+from app.models import User, Suggestion, followers
+
+#offline "who to follow" job. the followers table is loaded once into array-backed adjacency lists
+#(compressed sparse rows: the users followed by user u are targets[offsets[u]:offsets[u + 1]], sorted),
+#which take 8 bytes per edge and per user id instead of a Python object per edge, so millions of edges fit in memory.
+#every user is then offered the friends of their friends they don't follow yet, ranked by how many of the
+#people they follow already follow that user, and the result is written to the suggestion table
+
+
+class FollowGraph(object):
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def load(cls, chunk_size=50000):
+        size = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+        counts = array('q', bytes(8 * (size + 1)))
+        targets = array('q')
+        previous = None
+        #rows arrive sorted by (follower_id, followed_id) so every adjacency list is built already sorted
+        for row in iter_rows(followers, ['follower_id', 'followed_id'], chunk_size):
+            edge = (row['follower_id'], row['followed_id'])
+            if edge == previous or None in edge:
+                continue #duplicate or incomplete rows in the association table
+            previous = edge
+            targets.append(edge[1])
+            counts[edge[0] + 1] += 1
+        for i in range(1, size + 1):
+            counts[i] += counts[i - 1]
+        return cls(counts, targets)
+
+    @property
+    def size(self):
+        return len(self.offsets) - 1
+
+    def followed(self, user_id):
+        if user_id >= self.size:
+            return self.targets[0:0]
+        return self.targets[self.offsets[user_id]:self.offsets[user_id + 1]]
+
+    #returns up to limit (suggested_id, mutual_count) pairs, most mutual follows first and lower ids first on ties
+    def suggest(self, user_id, limit):
+        followed = self.followed(user_id)
+        counts = {}
+        for friend in followed:
+            for candidate in self.followed(friend):
+                counts[candidate] = counts.get(candidate, 0) + 1
+        counts.pop(user_id, None)
+        for candidate in list(counts):
+            position = bisect_left(followed, candidate)
+            if position < len(followed) and followed[position] == candidate:
+                del counts[candidate]
+        return heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+#recomputes every user's suggestions, replacing them one block of user ids per transaction
+def build(batch_size=1000, limit=None):
+    limit = limit or app.config['SUGGESTIONS_PER_USER']
+    graph = FollowGraph.load()
+    total = 0
+    for low in range(0, graph.size, batch_size):
+        high = min(low + batch_size, graph.size)
+        rows = []
+        for user_id in range(low, high):
+            for rank, (suggested_id, mutual_count) in enumerate(graph.suggest(user_id, limit)):
+                rows.append({'user_id': user_id, 'rank': rank, 'suggested_id': suggested_id,
+                             'mutual_count': mutual_count})
+        db.session.execute(Suggestion.__table__.delete().where(
+            Suggestion.user_id >= low, Suggestion.user_id < high))
+        if rows:
+            db.session.execute(Suggestion.__table__.insert(), rows)
+        db.session.commit()
+        total += len(rows)
+    return total
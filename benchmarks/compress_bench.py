@@ -0,0 +1,93 @@
+#bytes on the wire and CPU cost per request of the compression middleware (app/compress.py), per endpoint and encoding.
+#'request ms' is the CPU time of the whole request (noisy, includes the view); 'mw ms' replays the endpoint's
+#uncompressed body through the middleware alone, which isolates what minifying and compressing cost
+#usage: python benchmarks/compress_bench.py --posts 2000 --repeat 50
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+workdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+
+from app import app, db, compress
+from app.models import User, Post, followers
+
+ENDPOINTS = ['/index', '/explore', '/user/user0', '/api/feed?per_page=50']
+#(label, Accept-Encoding, minify HTML); 'off' bypasses the middleware altogether and is the baseline
+VARIANTS = [('off', '', False), ('plain', '', False), ('minified', '', True)] + \
+    [(encoding, encoding, True) for encoding in ('gzip', 'br', 'zstd') if encoding in compress.STREAMS]
+
+
+def seed(posts, users=100):
+    db.session.execute(User.__table__.insert(), [
+        {'id': i + 1, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)} for i in range(users)])
+    db.session.execute(followers.insert(), [{'follower_id': 1, 'followed_id': i + 1} for i in range(1, users)])
+    start = datetime.utcnow() - timedelta(days=7)
+    db.session.execute(Post.__table__.insert(), [
+        {'body': 'post number {} about the coffee we had this morning'.format(n), 'user_id': n % users + 1,
+         'language': 'en', 'timestamp': start + timedelta(minutes=n)} for n in range(posts)])
+    db.session.commit()
+
+
+def client_for(user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+    return client
+
+
+def measure(client, path, accept_encoding, repeat, headers):
+    client.get(path, headers=dict(headers, **{'Accept-Encoding': accept_encoding})) #warm up caches first
+    sizes = []
+    started = time.process_time()
+    for _ in range(repeat):
+        response = client.get(path, headers=dict(headers, **{'Accept-Encoding': accept_encoding}))
+        sizes.append(len(response.get_data()))
+    return response, (time.process_time() - started) / repeat * 1000
+
+
+def middleware_cost(response, accept_encoding, repeat):
+    body = response.get_data()
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', response.headers['Content-Type'])])
+        return [body]
+    wsgi = compress.Compressor(application, app.config)
+    environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': accept_encoding}
+    started = time.process_time()
+    for _ in range(repeat):
+        b''.join(wsgi(environ, lambda status, headers, exc_info=None: None))
+    return (time.process_time() - started) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    with app.app_context():
+        db.create_all()
+        seed(args.posts)
+        token = db.session.get(User, 1).get_access_token()
+    app.config['POSTS_PER_PAGE'] = 25 #a realistic page length instead of the tutorial's 3
+    middleware = app.wsgi_app
+    client = client_for(1)
+    api_headers = {'Authorization': 'Bearer ' + token}
+    print('{:<24} {:>9} {:>8} {:>6} {:>11} {:>7}'.format('endpoint', 'variant', 'bytes', 'saved', 'request ms', 'mw ms'))
+    for path in ENDPOINTS:
+        headers = api_headers if path.startswith('/api/') else {}
+        baseline = None
+        for label, accept_encoding, minify in VARIANTS:
+            app.config['COMPRESS_MINIFY_HTML'] = minify
+            app.wsgi_app = middleware.wsgi_app if label == 'off' else middleware
+            response, cpu = measure(client, path, accept_encoding, args.repeat, headers)
+            size = len(response.get_data())
+            if baseline is None:
+                baseline = response
+            mw = 0.0 if label == 'off' else middleware_cost(baseline, accept_encoding, args.repeat * 10)
+            print('{:<24} {:>9} {:>8} {:>5.0f}% {:>11.2f} {:>7.3f}'.format(
+                path, label, size, 100.0 * (1 - float(size) / len(baseline.get_data())), cpu, mw))
+    app.wsgi_app = middleware
@@ -0,0 +1,66 @@
+#memory and latency of rendering data for a 1,000 row feed page: ORM objects versus the PostRow path in app/feeds.py
+#usage: python benchmarks/feed_bench.py --rows 1000 --repeat 20
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+workdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+
+from app import app, db, feeds
+from app.models import User, Post
+
+
+def seed(posts, users=200):
+    db.session.execute(User.__table__.insert(), [
+        {'id': i + 1, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)} for i in range(users)])
+    start = datetime.utcnow() - timedelta(days=30)
+    db.session.execute(Post.__table__.insert(), [
+        {'body': 'post number {} about coffee'.format(n), 'user_id': n % users + 1, 'language': 'en',
+         'timestamp': start + timedelta(minutes=n)} for n in range(posts)])
+    db.session.commit()
+
+
+#reads every field _post.html uses, the way the template did before the row path
+def orm_page(rows):
+    posts = Post.query.order_by(Post.timestamp.desc()).limit(rows).all()
+    return [(p.id, p.body, p.timestamp, p.language, p.author.username, p.author.avatar(70)) for p in posts]
+
+
+def row_page(rows):
+    posts = feeds.paginate(feeds.explore_feed(), 1, rows).items
+    return [(p.id, p.body, p.timestamp, p.language, p.username, p.avatar(70)) for p in posts]
+
+
+def measure(name, page, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        db.session.remove() #start every run with an empty identity map, like a new request
+        started = time.perf_counter()
+        page(rows)
+        timings.append(time.perf_counter() - started)
+    db.session.remove()
+    tracemalloc.start()
+    result = page(rows)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    timings.sort()
+    print('{:>4}: {} rows  p50 {:.2f}ms  p95 {:.2f}ms  peak {:.0f} KiB'.format(
+        name, len(result), timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.95)] * 1000, peak / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    with app.app_context():
+        db.create_all()
+        seed(args.rows * 5)
+        measure('orm', orm_page, args.rows, args.repeat)
+        measure('rows', row_page, args.rows, args.repeat)
@@ -0,0 +1,74 @@
+#indexing and query benchmark for the post search backends (app/search.py)
+#usage: python benchmarks/search_bench.py --posts 1000000 --backend fts5
+#the posts are written to a throwaway SQLite file so the real app.db is never touched
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+workdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+
+from app import app, db
+from app.models import User, Post
+
+
+#a small vocabulary with a skewed distribution, so some terms are very common and others rare like in real posts
+vocabulary = ['coffee', 'espresso', 'latte', 'beans', 'roast', 'morning', 'cup', 'shop', 'milk', 'sugar'] + \
+    ['word{}'.format(i) for i in range(5000)]
+cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocabulary))))
+
+
+def words(count):
+    return random.choices(vocabulary, cum_weights=cum_weights, k=count)
+
+
+def seed(posts, batch=50000):
+    db.session.execute(User.__table__.insert(), [
+        {'id': i + 1, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)} for i in range(1000)])
+    start = datetime.utcnow() - timedelta(days=365)
+    for offset in range(0, posts, batch):
+        db.session.execute(Post.__table__.insert(), [
+            {'body': ' '.join(words(random.randint(4, 20))), 'user_id': random.randint(1, 1000),
+             'timestamp': start + timedelta(seconds=n * 31536000.0 / posts)}
+            for n in range(offset, min(offset + batch, posts))])
+        db.session.commit()
+
+
+def bench(backend, queries):
+    app.config['SEARCH_BACKEND'] = backend
+    started = time.perf_counter()
+    Post.reindex()
+    print('{:>7} reindex: {:.2f}s'.format(backend, time.perf_counter() - started))
+    for expression in ['coffee', 'morning latte', 'word42', 'word4999 coffee']:
+        timings = []
+        cursor = None
+        for _ in range(queries):
+            started = time.perf_counter()
+            posts, next_cursor = Post.search(expression, cursor, 20)
+            timings.append(time.perf_counter() - started)
+            cursor = next_cursor #walk further down the result list with every query to include deep pages
+        timings.sort()
+        print('{:>7} {!r:>20}: p50 {:.2f}ms  p95 {:.2f}ms'.format(
+            backend, expression, timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.95)] * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--backend', choices=['fts5', 'memory', 'both'], default='both')
+    args = parser.parse_args()
+    random.seed(1)
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        seed(args.posts)
+        print('seeded {} posts in {:.2f}s'.format(args.posts, time.perf_counter() - started))
+        for backend in (['fts5', 'memory'] if args.backend == 'both' else [args.backend]):
+            bench(backend, args.queries)
@@ -0,0 +1,167 @@
+#concurrency stress test for the write paths: workers (threads or processes) follow, unfollow and post at random
+#among a small group of users, so the same pairs and the same rollup rows are hit at the same time, against a
+#file-backed SQLite database. afterwards the database is checked: no duplicate follow pairs, every user's
+#new_followers rollups add up to their follower count and their posts rollups to their post count.
+#'write wait' is the time spent in INSERT/UPDATE/DELETE statements and commits, which is where a worker waits
+#for the database lock (busy_timeout); 'locked' counts operations that gave up with 'database is locked'
+#usage: python benchmarks/stress_follow.py --mode threads --workers 8 --ops 500
+#       python benchmarks/stress_follow.py --mode processes --workers 4 --ops 500
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+#worker processes started with 'spawn' import this module again and must find the same database
+os.environ.setdefault('STRESS_DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stress.db'))
+os.environ['DATABASE_URL'] = os.environ['STRESS_DATABASE_URL']
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from app import app, db
+from app.models import User, Post, ActivityRollup, followers, record_activity
+
+OPERATIONS = ['follow', 'unfollow', 'post']
+_timings = threading.local()
+
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(connection, cursor, statement, parameters, context, executemany):
+    _timings.started = time.perf_counter()
+
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(connection, cursor, statement, parameters, context, executemany):
+    if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+        _timings.wait = getattr(_timings, 'wait', 0.0) + time.perf_counter() - _timings.started
+
+
+def seed(users):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i + 1, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)} for i in range(users)])
+    db.session.commit()
+
+
+def perform(operation, user, other):
+    if operation == 'follow':
+        user.follow(other)
+    elif operation == 'unfollow':
+        user.unfollow(other)
+    else:
+        db.session.add(Post(body='stress test post', user_id=user.id, language='en'))
+        record_activity(user.id, posts=1)
+
+
+#runs in a thread or a worker process; returns (operations done, operations that failed on the lock,
+#seconds spent writing, per operation write times)
+def run(worker, ops, users, weights):
+    rng = random.Random(worker)
+    done = locked = 0
+    waits = []
+    with app.app_context():
+        for _ in range(ops):
+            operation = rng.choices(OPERATIONS, weights)[0]
+            first, second = rng.sample(range(1, users + 1), 2)
+            _timings.wait = 0.0
+            try:
+                perform(operation, db.session.get(User, first), db.session.get(User, second))
+                started = time.perf_counter()
+                db.session.commit()
+                _timings.wait += time.perf_counter() - started
+                done += 1
+            except OperationalError:
+                db.session.rollback()
+                locked += 1
+            waits.append(_timings.wait)
+        db.session.remove()
+    return done, locked, waits
+
+
+def _init_process():
+    #a forked worker must not use the connections it inherited from the parent
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def _run_process(args):
+    return run(*args)
+
+
+def stress(mode, workers, ops, users, weights):
+    jobs = [(worker, ops, users, weights) for worker in range(workers)]
+    started = time.perf_counter()
+    if mode == 'threads':
+        results = [None] * workers
+        def target(worker):
+            results[worker] = run(*jobs[worker])
+        threads = [threading.Thread(target=target, args=(worker,)) for worker in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_process) as pool:
+            results = pool.map(_run_process, jobs)
+    return results, time.perf_counter() - started
+
+
+#returns a list of problems found in the database, empty when every invariant holds
+def check():
+    problems = []
+    duplicates = db.session.query(followers.c.follower_id, followers.c.followed_id).group_by(
+        followers.c.follower_id, followers.c.followed_id).having(db.func.count() > 1).all()
+    if duplicates:
+        problems.append('{} duplicate follow pairs, e.g. {}'.format(len(duplicates), duplicates[0]))
+    follower_counts = dict(db.session.query(followers.c.followed_id, db.func.count()).group_by(followers.c.followed_id))
+    post_counts = dict(db.session.query(Post.user_id, db.func.count()).group_by(Post.user_id))
+    rollups = db.session.query(ActivityRollup.user_id, db.func.sum(ActivityRollup.new_followers),
+                               db.func.sum(ActivityRollup.posts)).group_by(ActivityRollup.user_id)
+    rollups = {user_id: (new_followers, posts) for user_id, new_followers, posts in rollups}
+    for user_id, in db.session.query(User.id):
+        new_followers, posts = rollups.get(user_id, (0, 0))
+        if new_followers != follower_counts.get(user_id, 0):
+            problems.append('user {}: {} followers, rollups count {}'.format(
+                user_id, follower_counts.get(user_id, 0), new_followers))
+        if posts != post_counts.get(user_id, 0):
+            problems.append('user {}: {} posts, rollups count {}'.format(user_id, post_counts.get(user_id, 0), posts))
+    return problems
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['threads', 'processes'], default='threads')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=500, help='operations per worker')
+    parser.add_argument('--users', type=int, default=20, help='fewer users means more collisions')
+    parser.add_argument('--mix', default='4:3:3', help='follow:unfollow:post weights')
+    args = parser.parse_args()
+    weights = [int(weight) for weight in args.mix.split(':')]
+    with app.app_context():
+        seed(args.users)
+        journal_mode = db.session.execute(db.text('PRAGMA journal_mode')).scalar()
+    results, elapsed = stress(args.mode, args.workers, args.ops, args.users, weights)
+    done = sum(result[0] for result in results)
+    locked = sum(result[1] for result in results)
+    waits = [wait for result in results for wait in result[2]]
+    print('{} {} x {} ops, {} users, journal_mode={}, busy_timeout={}ms'.format(
+        args.workers, args.mode, args.ops, args.users, journal_mode, app.config['SQLITE_BUSY_TIMEOUT']))
+    print('throughput  {:.0f} ops/s ({} done, {} locked, {:.2f}s)'.format(done / elapsed, done, locked, elapsed))
+    print('write wait  {:.1f}s total, {:.2f}ms mean, {:.2f}ms p99, {:.1f}ms max'.format(
+        sum(waits), sum(waits) / max(1, len(waits)) * 1000, _percentile(waits, 0.99) * 1000, max(waits or [0]) * 1000))
+    with app.app_context():
+        problems = check()
+    for problem in problems[:20]:
+        print('FAILED ' + problem)
+    print('invariants  ' + ('{} problems'.format(len(problems)) if problems else 'ok'))
+    sys.exit(1 if problems else 0)
@@ -11,6 +11,9 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLITE_WAL = True #write-ahead log: readers do not block the writer and the writer does not block readers
+    SQLITE_BUSY_TIMEOUT = 5000 #milliseconds a writer waits for the database lock before 'database is locked'
+    LAST_SEEN_UPDATE_INTERVAL = 60 #seconds; last_seen is written at most this often per user, not on every request
     MAIL_SERVER = os.environ.get('MAIL_SERVER') #defines class attribute MAIL_SERVER and assign it the value of the environment variable named MAIL_SERVER
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25) #defines a class attribute MAIL_PORT and assigns it the value of the variable named MAIL_PORT, converted to an integer.if not set or empty default to 25 
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None #checks if eviroment variable named MAIL_USE_TLS is set to any value. set -> true not set -> false
@@ -21,5 +24,71 @@ class Config(object):
     POSTS_PER_PAGE = 3 #how many items will be displayed per page
 
     LANGUAGES = ['en', 'es']
+    LOCALE_CACHE_SIZE = 512 #distinct Accept-Language headers whose negotiated language is remembered
 
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') #'fts5' or 'memory'; when unset fts5 is used on SQLite and memory everywhere else
+    SEARCH_RECENCY_WEIGHT = 0.01 #score added per day of post age so that newer posts rank above equally relevant older ones
+
+    SUGGESTIONS_PER_USER = 10 #how many who-to-follow suggestions 'flask suggestions build' stores per user
+    SUGGESTIONS_SHOWN = 5 #how many of them are shown on the home and profile pages
+
+    TRENDING_HOURS = 24 #how far back the trending page looks
+    TRENDING_FOLLOWER_WEIGHT = 3 #a new follower counts as much as this many posts when ranking trending authors
+    ROLLUP_HOURLY_RETENTION = 48 #hours of hourly activity kept before 'flask rollups compact' folds them into days
+
+    FOLLOW_CACHE_SIZE = 1024 #users whose followed ids are kept in memory per process
+    FOLLOW_CACHE_TTL = 5 #seconds before a cached entry is reloaded, bounds staleness from follows made in other processes
+    FOLLOW_CACHE_MAX_IDS = 5000 #users following more people than this are not cached
+
+    #an open stream holds its worker until the client leaves, so streams need an async worker class (gevent or eventlet,
+    #see serve.py); set STREAM_ENABLED=0 to serve under sync or gthread workers, the home page then does not open one
+    STREAM_ENABLED = os.environ.get('STREAM_ENABLED', '1') != '0'
+    #'module:Class' of the pub/sub broker behind /stream; with more than one worker use 'app.stream:RedisBroker'
+    STREAM_BROKER = os.environ.get('STREAM_BROKER') or 'app.stream:LocalBroker'
+    STREAM_REDIS_URL = os.environ.get('STREAM_REDIS_URL') or 'redis://localhost:6379/0' #used by RedisBroker
+    STREAM_HEARTBEAT = 15 #seconds between keep-alive comments on an idle stream
+    STREAM_RETRY_MS = 5000 #how long browsers wait before reconnecting a dropped stream
+    STREAM_QUEUE_SIZE = 100 #undelivered messages kept per open stream
+
+    ASSETS_DIST = os.path.join(basedir, 'app', 'static', 'dist') #output of 'flask assets build', served under /assets
+    ASSETS_VENDOR = os.path.join(basedir, 'app', 'static', 'vendor') #third party files downloaded by the build
+    ASSETS_MAX_AGE = 31536000 #one year; built files are content-hashed so they never change under the same URL
+
+    ARCHIVE_HORIZON_DAYS = 30 #posts older than this are moved to the archive table by 'flask posts archive'
+    ARCHIVE_BATCH_SIZE = 1000 #posts moved per transaction
+
+    MIGRATION_BATCH_SIZE = 1000 #rows per transaction in batched migrations (app/batchmigrate.py)
+    MIGRATION_ROWS_PER_SECOND = int(os.environ.get('MIGRATION_ROWS_PER_SECOND') or 0) #throttle for batched migrations, 0 for none
+
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'profiles') #where profiled requests are saved
+    PROFILE_MODE = os.environ.get('PROFILE_MODE') or 'cprofile' #'cprofile' or 'sample' (thread workers only, see app/profiling.py)
+    PROFILE_INTERVAL = 0.005 #seconds between stack samples in sample mode
+    PROFILE_LINES = 60 #functions shown in the report of a cProfile profile
+
+    AVAILABILITY_CAPACITY = 100000 #names the availability filter is sized for at least; it grows with the user table
+    AVAILABILITY_ERROR_RATE = 0.01 #share of free names that still need a query to confirm
+    AVAILABILITY_REBUILD_INTERVAL = 3600 #seconds between rebuilds, picks up names registered through other processes
+
+    API_TOKEN_EXPIRES = 900 #seconds an API access token is valid; revoked tokens are remembered for at most this long
+    API_TOKEN_DENYLIST_REFRESH = 5 #seconds between reloads of the revoked token table; how long a revoked token still works on other workers
+
+    SERVER_BIND = os.environ.get('SERVER_BIND') or '0.0.0.0:8000' #address 'python serve.py' listens on
+    SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS') or (os.cpu_count() or 1) * 2 + 1) #worker processes
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS') or 4) #threads per worker with the gthread worker class
+    #'gevent' or 'eventlet' (needs the package installed), or 'sync'/'gthread' together with STREAM_ENABLED=0
+    SERVER_WORKER_CLASS = os.environ.get('SERVER_WORKER_CLASS') or 'gevent'
+    SERVER_WORKER_CONNECTIONS = int(os.environ.get('SERVER_WORKER_CONNECTIONS') or 1000) #open connections per gevent/eventlet worker
+    SERVER_TIMEOUT = 30 #seconds a worker may be silent before it is killed and replaced
+    SERVER_GRACEFUL_TIMEOUT = 30 #seconds workers get to finish their requests on reload or shutdown
+    SERVER_KEEPALIVE = 5 #seconds an idle keep-alive connection is held open
+    SERVER_MAX_REQUESTS = 1000 #requests after which a worker is replaced, bounds slow memory growth
+    SERVER_PIDFILE = os.environ.get('SERVER_PIDFILE') or os.path.join(basedir, 'serve.pid') #used by 'python serve.py reload'
+
+    COMPRESS_ENCODINGS = ['br', 'zstd', 'gzip'] #in order of preference; br and zstd need the brotli and zstandard packages
+    COMPRESS_LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3} #per response CPU cost grows quickly above these
+    COMPRESS_MIN_SIZE = 500 #bytes; smaller responses are sent uncompressed
+    COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                          'application/json', 'image/svg+xml']
+    COMPRESS_MINIFY_HTML = True #collapse whitespace in HTML pages before they are compressed
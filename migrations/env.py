@@ -97,6 +97,9 @@ def run_migrations_online():
             connection=connection,
             target_metadata=get_metadata(),
             process_revision_directives=process_revision_directives,
+            # each migration commits on its own, so migrations can use
+            # autocommit_block() for batched backfills (app/batchmigrate.py)
+            transaction_per_migration=True,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,27 @@
+"""post search index
+
+Revision ID: 4f1c2a9d7e31
+Revises: 82e565a80216
+Create Date: 2026-10-19 09:12:40.518203
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4f1c2a9d7e31'
+down_revision = '82e565a80216'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 virtual tables only exist on SQLite; other databases use the in-memory search backend
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)')
+        op.execute('INSERT INTO post_fts(rowid, body) SELECT id, body FROM post')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS post_fts')
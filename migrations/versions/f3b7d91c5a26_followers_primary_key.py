@@ -0,0 +1,45 @@
+"""followers primary key
+
+Revision ID: f3b7d91c5a26
+Revises: e5a9c3d27f40
+Create Date: 2026-10-19 21:04:12.630118
+
+"""
+import sqlalchemy as sa
+from app import batchmigrate
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b7d91c5a26'
+down_revision = 'e5a9c3d27f40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # followers is rebuilt through a shadow table: duplicate pairs left by the old check-then-insert follow()
+    # are copied once and rows with a missing side are dropped, in batches (see app/batchmigrate.py).
+    # every step is safe to repeat, so a run that was interrupted is finished by running the upgrade again
+    batchmigrate.create_table('_followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    batchmigrate.copy_table('followers_primary_key', 'followers', '_followers_new', ['follower_id', 'followed_id'],
+                            key='follower_id', distinct=True,
+                            where=sa.text('follower_id IS NOT NULL AND followed_id IS NOT NULL'))
+    batchmigrate.swap_tables('followers', '_followers_new')
+
+
+def downgrade():
+    batchmigrate.create_table('_followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    batchmigrate.copy_table('followers_primary_key_downgrade', 'followers', '_followers_new',
+                            ['follower_id', 'followed_id'], key='follower_id')
+    batchmigrate.swap_tables('followers', '_followers_new')
@@ -0,0 +1,165 @@
+#production launcher: runs the application under gunicorn with prefork workers configured from config.py.
+#  python serve.py            start the server (the master process writes SERVER_PIDFILE)
+#  python serve.py reload     zero-downtime reload of new code: starts a new master next to the running one and
+#                             gracefully stops the old one once the new one is serving
+#  kill -HUP <master pid>     restart the workers with the same code (config and worker count changes)
+#the application is imported once in the master before the workers are forked (preload), so workers start fast and
+#share its memory; each worker then drops the database connections it inherited and opens its own pool. with the
+#gevent or eventlet worker class the master monkey-patches the standard library before anything else is imported,
+#so the locks, the connection pools and the threads created while importing the application are green ones.
+#worker classes: 'gevent' (the default) or 'eventlet' run each request in a greenlet, so the long-lived /stream
+#connections cost next to nothing while they wait (SERVER_WORKER_CONNECTIONS per process); they need the package
+#installed. 'sync' (one request per process) and 'gthread' (SERVER_THREADS threads per process) would give each
+#open stream a whole thread and are only accepted with STREAM_ENABLED=0. more than one worker also needs a shared
+#/stream broker (see app/stream.py)
+#dependencies of the production server, not needed for development: pip install gunicorn gevent (or eventlet when
+#SERVER_WORKER_CLASS=eventlet, and redis for STREAM_BROKER=app.stream:RedisBroker). gunicorn only runs on Unix; use
+#'flask run' for development
+import importlib
+import os
+import signal
+import sys
+import time
+
+from config import Config
+
+ASYNC_WORKERS = ('gevent', 'eventlet')
+
+
+#patches the standard library for the gevent and eventlet worker classes. has to run before gunicorn and the
+#application are imported; without the package installed it does nothing and check_worker_class() reports it
+def monkey_patch(config=Config):
+    try:
+        if config.SERVER_WORKER_CLASS == 'gevent':
+            from gevent import monkey
+            monkey.patch_all()
+        elif config.SERVER_WORKER_CLASS == 'eventlet':
+            import eventlet
+            eventlet.monkey_patch()
+    except ImportError:
+        pass
+
+
+if __name__ == '__main__' and sys.argv[1:2] != ['reload']:
+    monkey_patch()
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError: #without gunicorn only the development server is available
+    BaseApplication = object
+
+
+def options(config=Config):
+    return {
+        'bind': config.SERVER_BIND,
+        'workers': config.SERVER_WORKERS,
+        'threads': config.SERVER_THREADS,
+        'worker_class': config.SERVER_WORKER_CLASS,
+        'worker_connections': config.SERVER_WORKER_CONNECTIONS,
+        'timeout': config.SERVER_TIMEOUT,
+        'graceful_timeout': config.SERVER_GRACEFUL_TIMEOUT,
+        'keepalive': config.SERVER_KEEPALIVE,
+        #workers are replaced after a number of requests (with jitter so they do not all restart together)
+        'max_requests': config.SERVER_MAX_REQUESTS,
+        'max_requests_jitter': config.SERVER_MAX_REQUESTS // 10,
+        'pidfile': config.SERVER_PIDFILE,
+        'preload_app': True,
+        'when_ready': when_ready,
+        'post_fork': post_fork,
+    }
+
+
+#returns why the configured worker class cannot serve this application, or None when it can
+def check_worker_class(config=Config):
+    worker_class = config.SERVER_WORKER_CLASS
+    if worker_class in ASYNC_WORKERS:
+        try:
+            importlib.import_module(worker_class)
+        except ImportError:
+            return 'SERVER_WORKER_CLASS is {0} but {0} is not installed: pip install {0}, or use ' \
+                'SERVER_WORKER_CLASS=gthread with STREAM_ENABLED=0'.format(worker_class)
+    elif config.STREAM_ENABLED:
+        return 'SERVER_WORKER_CLASS {} holds a thread for every open /stream connection: use gevent or ' \
+            'eventlet, or set STREAM_ENABLED=0'.format(worker_class)
+    return None
+
+
+#returns why the /stream broker cannot reach the streams of every worker, or None when it can
+def check_stream_broker(config=Config):
+    if config.STREAM_ENABLED and config.SERVER_WORKERS > 1 and config.STREAM_BROKER == 'app.stream:LocalBroker':
+        return 'STREAM_BROKER LocalBroker only reaches the /stream connections of its own worker, so with ' \
+            'SERVER_WORKERS={} most new posts would never be announced: use STREAM_BROKER=app.stream:RedisBroker, ' \
+            'SERVER_WORKERS=1 or STREAM_ENABLED=0'.format(config.SERVER_WORKERS)
+    return None
+
+
+def _engine():
+    from app import app, db
+    with app.app_context():
+        return db.engine
+
+
+#runs in the master after the application is loaded, before the first fork: nothing opened while importing the
+#application (or by the master) may be shared with the workers
+def when_ready(server):
+    _engine().dispose()
+
+
+#runs in each new worker. close=False drops the inherited pool without closing its connections, which would also
+#close them for the process they came from
+def post_fork(server, worker):
+    _engine().dispose(close=False)
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super(Server, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def _read_pid(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+#USR2 makes gunicorn start a new master with freshly imported code; once its workers are up the old master is
+#sent TERM, which stops it after its workers finish their requests (up to SERVER_GRACEFUL_TIMEOUT)
+def reload(config=Config, wait=60, boot_wait=5):
+    old = _read_pid(config.SERVER_PIDFILE)
+    if old is None:
+        sys.exit('no running server found in ' + config.SERVER_PIDFILE)
+    os.kill(old, signal.SIGUSR2)
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        new = _read_pid(config.SERVER_PIDFILE)
+        if new is not None and new != old:
+            time.sleep(boot_wait) #the pidfile is written before the workers are forked, give them time to boot
+            os.kill(old, signal.SIGTERM)
+            print('reloaded: master {} replaced by {}'.format(old, new))
+            return
+        time.sleep(0.5)
+    sys.exit('the new master did not start within {} seconds, the old one keeps running'.format(wait))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'reload':
+        reload()
+    elif BaseApplication is object:
+        sys.exit('gunicorn is not installed: pip install gunicorn')
+    else:
+        for check in (check_worker_class, check_stream_broker):
+            problem = check()
+            if problem is not None:
+                sys.exit(problem)
+        Server(options()).run()
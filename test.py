@@ -2,15 +2,32 @@ import os
 os.environ['DATABASE_URL'] = 'sqlite://'
 
 from datetime import datetime, timedelta
+from flask import g
+from flask_login import login_user
+import base64
+import gzip
+import jwt
+import shutil
+import tempfile
 import unittest
-from app import app, db
-from app.models import User, Post
+from unittest import mock
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from app import app, db, cli, get_locale, negotiate_locale
+from app.models import User, Post, PostArchive, followers, token_denylist, ActivityRollup, record_activity, followed_cache, \
+    RevokedToken
+from app import rollups, feeds, assets, archive, batchmigrate, profiling, catalogs, availability, api, compress
+from app.stream import LocalBroker, get_broker, events
+from app.followcache import FollowCache
+from app.denylist import TokenDenylist
+import serve
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         self.app_context = app.app_context()
         self.app_context.push()
         db.create_all()
+        followed_cache.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -52,6 +69,27 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_idempotent(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        new_followers = lambda: db.session.query(db.func.sum(ActivityRollup.new_followers)).filter(
+            ActivityRollup.user_id == u2.id).scalar()
+
+        # a repeated follow changes nothing and is not counted twice
+        self.assertTrue(u1.follow(u2))
+        self.assertFalse(u1.follow(u2))
+        db.session.commit()
+        self.assertEqual(db.session.query(followers).count(), 1)
+        self.assertEqual(new_followers(), 1)
+
+        self.assertTrue(u1.unfollow(u2))
+        self.assertFalse(u1.unfollow(u2))
+        db.session.commit()
+        self.assertEqual(db.session.query(followers).count(), 0)
+        self.assertEqual(new_followers(), 0)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -90,5 +128,737 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+        # the row based feeds return the same posts in the same order
+        for user, posts in [(u1, f1), (u2, f2), (u3, f3), (u4, f4)]:
+            page = feeds.paginate(feeds.followed_feed(user.id), 1, 10)
+            self.assertEqual([row.id for row in page.items], [p.id for p in posts])
+            self.assertFalse(page.has_next)
+        page = feeds.paginate(feeds.explore_feed(), 2, 3)
+        self.assertEqual([row.id for row in page.items], [p1.id])
+        self.assertEqual((page.has_prev, page.prev_num, page.has_next), (True, 1, False))
+        self.assertEqual(page.items[0].username, 'john')
+        self.assertEqual(page.items[0].avatar(128), u1.avatar(128))
+
+    def test_suggested_users(self):
+        users = [User(username=name, email=name + '@example.com')
+                 for name in ['john', 'susan', 'mary', 'david', 'anna']]
+        john, susan, mary, david, anna = users
+        db.session.add_all(users)
+        db.session.commit()
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(david)
+        mary.follow(david)
+        mary.follow(anna)
+        susan.follow(john)
+        mary.follow(susan)
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['suggestions', 'build'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        # david is followed by two of john's friends, anna by one; susan is already followed and john is himself
+        self.assertEqual(john.suggested_users(), [david, anna])
+        self.assertEqual(susan.suggested_users(), [mary])
+        self.assertEqual(anna.suggested_users(), [])
+
+    def test_activity_rollups(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        now = datetime.utcnow()
+        record_activity(u1.id, posts=1, when=now - timedelta(days=3))
+        record_activity(u1.id, posts=1, when=now - timedelta(days=3))
+        record_activity(u1.id, posts=1)
+        record_activity(u2.id, posts=1)
+        record_activity(u3.id, posts=1, when=now - timedelta(days=3))
+        u1.follow(u2)
+        u3.follow(u2)
+        u3.follow(u1)
+        u3.unfollow(u1)
+        db.session.commit()
+
+        self.assertEqual(rollups.trending_authors(), [u2.id, u1.id])
+        self.assertEqual(rollups.compact(), 2)
+        self.assertEqual(ActivityRollup.query.filter_by(granularity='day').count(), 2)
+        # a window longer than the hourly retention also reads the compacted daily rows
+        self.assertEqual(rollups.trending_authors(), [u2.id, u1.id])
+        self.assertEqual(rollups.trending_authors(hours=96), [u2.id, u1.id, u3.id])
+        activity = rollups.user_activity(u1.id)
+        self.assertEqual(len(activity), 7)
+        self.assertEqual([(posts, followers) for day, posts, followers in activity][3:],
+                         [(2, 0), (0, 0), (0, 0), (1, 0)])
+        self.assertEqual(rollups.user_activity(u2.id)[-1][1:], (1, 2))
+
+    def test_locale_selection(self):
+        negotiate_locale.cache_clear()
+        with app.test_request_context(headers={'Accept-Language': 'es-MX,es;q=0.9,en;q=0.5'}):
+            self.assertEqual(str(get_locale()), 'es')
+        with app.test_request_context(headers={'Accept-Language': 'es-MX,es;q=0.9,en;q=0.5'}):
+            self.assertEqual(str(get_locale()), 'es')
+        with app.test_request_context(headers={'Accept-Language': 'fr'}):
+            self.assertIsNone(get_locale())
+        self.assertEqual(negotiate_locale.cache_info().hits, 1)
+
+        # a saved preference overrides the header
+        u = User(username='john', email='john@example.com', locale='en')
+        db.session.add(u)
+        db.session.commit()
+        with app.test_request_context(headers={'Accept-Language': 'es'}):
+            login_user(u)
+            self.assertEqual(str(get_locale()), 'en')
+        self.assertEqual(negotiate_locale.cache_info().misses, 2)
+
+    def test_api_tokens(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        now = datetime.utcnow()
+        db.session.add_all([u1, u2, Post(body='from susan', author=u2, timestamp=now - timedelta(seconds=1)),
+                            Post(body='from john', author=u1, timestamp=now)])
+        u1.follow(u2)
+        db.session.commit()
+        token_denylist.clear()
+        client = app.test_client()
+        auth = {'Authorization': 'Basic ' + base64.b64encode(b'john:dog').decode()}
+        self.assertEqual(client.post('/api/tokens', headers=auth).status_code, 401)
+        auth = {'Authorization': 'Basic ' + base64.b64encode(b'john:cat').decode()}
+        token = client.post('/api/tokens', headers=auth).get_json()['token']
+        bearer = {'Authorization': 'Bearer ' + token}
+
+        # authenticating a request with the token runs no query while the denylist copy is fresh
+        self.assertIsNotNone(User.verify_access_token(token))
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', record)
+        with app.test_request_context(headers=bearer):
+            self.assertEqual(api.token_required(lambda: g.token_user)().username, 'john')
+        db.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(statements, [])
+
+        feed = client.get('/api/feed', headers=bearer).get_json()
+        self.assertEqual([post['body'] for post in feed['items']], ['from john', 'from susan'])
+        self.assertEqual(client.get('/api/feed').status_code, 401)
+        self.assertIsNone(User.verify_access_token(u1.get_access_token(expires_in=-1)))
+        self.assertIsNone(User.verify_access_token(u1.get_reset_password_token()))
+
+        # revoking one token, then every token of a user
+        self.assertEqual(client.delete('/api/tokens', headers=bearer).status_code, 204)
+        self.assertEqual(client.get('/api/feed', headers=bearer).status_code, 401)
+        other = u1.get_access_token()
+        self.assertIsNotNone(User.verify_access_token(other))
+        token_denylist.revoke_user(u1.id)
+        db.session.commit()
+        self.assertIsNone(User.verify_access_token(other))
+
+        # other worker processes pick the revocations up from the table on their next reload
+        worker = TokenDenylist(RevokedToken, 900, 0)
+        claims = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        self.assertTrue(worker.is_revoked(claims['jti'], u2.id, claims['iat']))
+        self.assertTrue(worker.is_revoked('other', u1.id, claims['iat']))
+        self.assertFalse(worker.is_revoked('other', u2.id, claims['iat']))
+
+        # revocations are deleted once the tokens they cover have expired
+        with mock.patch('time.time', return_value=claims['exp'] + 900):
+            token_denylist.revoke('later', claims['exp'] + 1800)
+            db.session.commit()
+            self.assertEqual([row.jti for row in RevokedToken.query], ['later'])
+            self.assertFalse(worker.is_revoked(claims['jti'], u1.id, claims['iat']))
+
+    def test_availability(self):
+        bloom = availability.BloomFilter(1000, 0.01)
+        for n in range(1000):
+            bloom.add('user{}'.format(n))
+        self.assertTrue(all('user{}'.format(n) in bloom for n in range(1000)))
+        false_positives = sum('other{}'.format(n) in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
+
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        availability.taken_names.rebuild()
+        client = app.test_client()
+        self.assertFalse(client.get('/availability?username=john').get_json()['available'])
+        self.assertTrue(client.get('/availability?username=susan').get_json()['available'])
+        self.assertEqual(client.get('/availability').status_code, 400)
+        # registered emails are not disclosed
+        self.assertEqual(client.get('/availability?email=john@example.com').status_code, 400)
+
+        # registrations and renames are added without a rebuild
+        db.session.add(User(username='susan', email='susan@example.com'))
+        u.username = 'johnny'
+        db.session.commit()
+        self.assertIn('susan', availability.taken_names.filter)
+        self.assertIn('johnny', availability.taken_names.filter)
+        self.assertFalse(client.get('/availability?username=johnny').get_json()['available'])
+        # the old name is still in the filter, the query confirms it is free again
+        self.assertTrue(client.get('/availability?username=john').get_json()['available'])
+
+        # without a filter requests are answered from the database while one rebuild runs in the background
+        taken_names = availability.TakenNames()
+        with mock.patch.object(availability.threading, 'Thread') as thread:
+            self.assertTrue(taken_names.is_taken('johnny'))
+            self.assertFalse(taken_names.is_taken('john'))
+        self.assertEqual(thread.call_count, 1)
+
+    def test_follow_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+
+        self.assertTrue(u1.is_following(u2))
+        u3.id # loads the expired attributes of u3 up front
+        # later checks are answered from memory without touching the database
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertTrue(u1.is_following(u2))
+            self.assertFalse(u1.is_following(u3))
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+
+        # follow and unfollow invalidate the entry
+        u1.follow(u3)
+        self.assertTrue(u1.is_following(u3))
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertFalse(u1.is_following(u2))
+        self.assertEqual(len(followed_cache.get(u1.id)), 1)
+
+        # an uncommitted follow is not cached, a rollback only drops the entries of the users it changed
+        followed_cache.get(u3.id)
+        u1.follow(u2)
+        self.assertTrue(u1.is_following(u2))
+        self.assertNotIn(u2.id, followed_cache.entries[u1.id][1])
+        db.session.rollback()
+        self.assertEqual(list(followed_cache.entries), [u3.id])
+        self.assertFalse(u1.is_following(u2))
+        self.assertTrue(u3.is_followed_by(u1))
+        self.assertFalse(u2.is_followed_by(u1))
+
+        # a user following too many people to cache is remembered as such, not loaded again on every check
+        loads = []
+        cache = FollowCache(lambda user_id, limit: loads.append(user_id) or [1, 2, 3], 10, 60, 2)
+        self.assertIsNone(cache.get(1))
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(loads, [1])
+
+class StreamCase(unittest.TestCase):
+    def test_local_broker(self):
+        broker = LocalBroker()
+        s1 = broker.subscribe(['user:1', 'user:2'])
+        s2 = broker.subscribe(['user:2'])
+        broker.publish('user:1', 'a')
+        broker.publish('user:2', 'b')
+        broker.publish('user:3', 'c')
+        self.assertEqual(s1.get(0), ['a', 'b'])
+        self.assertEqual(s2.get(0), ['b'])
+        self.assertEqual(s2.get(0), [])
+
+        broker.unsubscribe(s2)
+        broker.publish('user:2', 'd')
+        self.assertEqual(s2.get(0), [])
+        self.assertEqual(broker.channels, {'user:1': {s1}, 'user:2': {s1}})
+
+    def test_events(self):
+        with app.app_context():
+            app.config['STREAM_HEARTBEAT'] = 0
+            subscription = LocalBroker().subscribe(['user:1'])
+            stream = events(subscription)
+            self.assertTrue(next(stream).startswith('retry:'))
+            self.assertEqual(next(stream), ': keep-alive\n\n')
+            subscription.put('{"id": 1}')
+            self.assertEqual(next(stream), 'event: post\ndata: {"id": 1}\n\n')
+            app.config['STREAM_HEARTBEAT'] = 15
+
+    def test_follow_while_streaming(self):
+        with app.app_context():
+            app.config['STREAM_HEARTBEAT'] = 0
+            broker = get_broker()
+            channels = ['user:1']
+            subscription = broker.subscribe(list(channels))
+            stream = events(subscription, lambda: list(channels))
+            next(stream)
+            channels.append('user:2')
+            self.assertEqual(next(stream), ': keep-alive\n\n')
+            self.assertEqual(subscription.channels, ['user:1', 'user:2'])
+            broker.publish('user:2', '{"id": 2}')
+            self.assertEqual(next(stream), 'event: post\ndata: {"id": 2}\n\n')
+            stream.close()
+            self.assertNotIn('user:2', broker.channels)
+            app.config['STREAM_HEARTBEAT'] = 15
+
+    def test_broker_check(self):
+        config = mock.Mock(STREAM_ENABLED=True, SERVER_WORKERS=4, STREAM_BROKER='app.stream:LocalBroker')
+        self.assertIn('RedisBroker', serve.check_stream_broker(config))
+        config.STREAM_BROKER = 'app.stream:RedisBroker'
+        self.assertIsNone(serve.check_stream_broker(config))
+        config.STREAM_BROKER, config.SERVER_WORKERS = 'app.stream:LocalBroker', 1
+        self.assertIsNone(serve.check_stream_broker(config))
+
+    def test_monkey_patch(self):
+        gevent = mock.Mock()
+        with mock.patch.dict('sys.modules', {'gevent': gevent, 'gevent.monkey': gevent.monkey}):
+            serve.monkey_patch(mock.Mock(SERVER_WORKER_CLASS='gthread'))
+            self.assertFalse(gevent.monkey.patch_all.called)
+            serve.monkey_patch(mock.Mock(SERVER_WORKER_CLASS='gevent'))
+            self.assertTrue(gevent.monkey.patch_all.called)
+
+    def test_disabled(self):
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            db.session.add(u)
+            db.session.commit()
+            user_id = u.id
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+        self.assertIn('EventSource', client.get('/index').get_data(as_text=True))
+        app.config['STREAM_ENABLED'] = False
+        try:
+            self.assertNotIn('EventSource', client.get('/index').get_data(as_text=True))
+            self.assertEqual(client.get('/stream').status_code, 404)
+        finally:
+            app.config['STREAM_ENABLED'] = True
+            with app.app_context():
+                db.drop_all()
+
+class PostSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        app.config['SEARCH_BACKEND'] = None
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def check_search(self, backend):
+        app.config['SEARCH_BACKEND'] = backend
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        p1 = Post(body='fresh coffee', author=u, timestamp=now - timedelta(days=30))
+        p2 = Post(body='coffee coffee beans', author=u, timestamp=now - timedelta(days=1))
+        p3 = Post(body='tea only', author=u, timestamp=now)
+        p4 = Post(body='Coffee again', author=u, timestamp=now)
+        db.session.add_all([u, p1, p2, p3, p4])
+        db.session.commit()
+
+        # pages are walked with the returned cursor until it runs out
+        page1, cursor = Post.search('coffee', per_page=2)
+        self.assertEqual(len(page1), 2)
+        page2, cursor2 = Post.search('coffee', cursor, per_page=2)
+        self.assertIsNone(cursor2)
+        self.assertEqual(set(page1 + page2), {p1, p2, p4})
+        self.assertEqual(page2, [p1])
+        self.assertEqual(Post.search('coffee beans')[0], [p2])
+        self.assertEqual(Post.search('"tea)')[0], [p3])
+
+        # posts added after the first query are picked up incrementally
+        p5 = Post(body='iced coffee', author=u, timestamp=now)
+        db.session.add(p5)
+        db.session.commit()
+        self.assertIn(p5, Post.search('iced')[0])
+
+    def test_fts5_search(self):
+        self.check_search('fts5')
+
+    def test_memory_search(self):
+        self.check_search('memory')
+
+class BulkDataCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def check_round_trip(self, fmt):
+        u1 = User(username='john', email='john@example.com', about_me='')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        timestamp = datetime(2023, 8, 8, 3, 3, 31, 82566)
+        p1 = Post(body='hello', author=u1, language='', timestamp=timestamp)
+        db.session.add_all([u1, u2, p1])
+        u1.follow(u2)
+        db.session.commit()
+        password_hash = u1.password_hash
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['data', 'export', self.directory, '--format', fmt, '--chunk-size', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        result = runner.invoke(args=['data', 'import', self.directory, '--format', fmt, '--batch-size', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('imported 2 users', result.output)
+
+        john = User.query.filter_by(username='john').first()
+        self.assertEqual(john.password_hash, password_hash)
+        self.assertEqual(john.about_me, '')
+        self.assertIsNone(User.query.filter_by(username='susan').first().about_me)
+        self.assertTrue(john.is_following(User.query.filter_by(username='susan').first()))
+        post = john.posts.first()
+        self.assertEqual((post.body, post.language, post.timestamp), ('hello', '', timestamp))
+        self.assertEqual(Post.search('hello')[0], [post])
+
+    def test_ndjson_round_trip(self):
+        self.check_round_trip('ndjson')
+
+    def test_csv_round_trip(self):
+        self.check_round_trip('csv')
+
+class PostArchiveCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        app.config['SEARCH_BACKEND'] = None
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def check_archive(self, backend):
+        app.config['SEARCH_BACKEND'] = backend
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        posts = [Post(body='coffee #{}'.format(n), author=u, timestamp=now - timedelta(days=n * 10))
+                 for n in range(6)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        self.assertEqual(len(Post.search('coffee', per_page=10)[0]), 6)
+        ids = [p.id for p in posts]
+
+        # posts older than 35 days move over in batches; the newest id stays even though it is old
+        newest = Post(body='late coffee', author=u, timestamp=now - timedelta(days=90))
+        db.session.add(newest)
+        db.session.commit()
+        self.assertEqual(archive.archive(horizon_days=35, batch_size=1), 2)
+        self.assertEqual(sorted(row.id for row in PostArchive.query), ids[4:])
+        self.assertEqual(Post.query.count(), 5)
+        self.assertEqual(archive.archive(horizon_days=35), 0)
+
+        # feed pages merge the post table and the archive in timestamp order; the kept back post sorts in last
+        feed = feeds.user_feed(u.id)
+        pages = [feeds.paginate(feed, page, 2) for page in range(1, 5)]
+        self.assertEqual([[row.id for row in page.items] for page in pages],
+                         [ids[0:2], ids[2:4], ids[4:6], [newest.id]])
+        self.assertEqual([page.has_next for page in pages], [True, True, True, False])
+        self.assertEqual(feeds.paginate(feed, 5, 2).items, [])
+        self.assertEqual(len(feeds.paginate(feed, 1, 2, archive=False).items), 2)
+
+        # archived posts are still found by search, also after a reindex, and a new post does not reuse an archived id
+        for reindex in (False, True):
+            if reindex:
+                Post.reindex()
+            rows, cursor = feeds.search_feed('coffee', None, 10)
+            self.assertEqual(sorted(row.id for row in rows), sorted(ids + [newest.id]))
+            self.assertEqual(sorted(post.id for post in Post.search('coffee', per_page=10)[0]), sorted(ids + [newest.id]))
+            self.assertEqual([row.id for row in feeds.search_feed('coffee #5', None, 10)[0]], [ids[5]])
+        post = Post(body='fresh coffee', author=u, timestamp=now)
+        db.session.add(post)
+        db.session.commit()
+        self.assertNotIn(post.id, ids)
+
+    def test_archive_fts5(self):
+        self.check_archive('fts5')
+
+    def test_archive_memory(self):
+        self.check_archive('memory')
+
+class BatchMigrateCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2] + [Post(body='post {}'.format(n), author=u1) for n in range(5)])
+        db.session.commit()
+        # followers as it was before it had a primary key, with duplicates and half empty rows
+        followers.drop(db.engine)
+        db.session.execute(db.text('CREATE TABLE followers (follower_id INTEGER, followed_id INTEGER)'))
+        db.session.execute(followers.insert(), [{'follower_id': 1, 'followed_id': 2}] * 3 +
+                           [{'follower_id': 2, 'followed_id': 1}, {'follower_id': 2, 'followed_id': None},
+                            {'follower_id': None, 'followed_id': 1}])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        batchmigrate.progress.drop(db.engine, checkfirst=True)
+        self.app_context.pop()
+
+    def migrate(self, upgrade):
+        db.session.remove()
+        with db.engine.connect() as connection:
+            context = MigrationContext.configure(connection, opts={'transaction_per_migration': True})
+            with Operations.context(context), context.begin_transaction():
+                upgrade()
+
+    def test_backfill(self):
+        # an interrupted run left progress after post 2, so only the rest is updated
+        batchmigrate.progress.create(db.engine)
+        db.session.execute(batchmigrate.progress.insert().values(name='language', last_key=2, rows=2))
+        db.session.commit()
+        self.migrate(lambda: batchmigrate.backfill('language', 'post', {'language': 'en'}, batch_size=2))
+        self.assertEqual([p.language for p in Post.query.order_by(Post.id)], [None, None, 'en', 'en', 'en'])
+        self.assertFalse(db.inspect(db.engine).has_table('migration_progress'))
+
+    def rebuild_followers(self):
+        batchmigrate.create_table('_followers_new',
+                                  db.Column('follower_id', db.Integer), db.Column('followed_id', db.Integer),
+                                  db.PrimaryKeyConstraint('follower_id', 'followed_id'))
+        batchmigrate.copy_table('followers', 'followers', '_followers_new', ['follower_id', 'followed_id'],
+                                key='follower_id', distinct=True, where=db.text('followed_id IS NOT NULL'),
+                                batch_size=1)
+        batchmigrate.swap_tables('followers', '_followers_new')
+
+    def test_copy_and_swap(self):
+        # batch_size=1: the NULL key row sorts first and must not end the copy early
+        self.migrate(self.rebuild_followers)
+        self.assertEqual(sorted(db.session.execute(db.select(followers)).all()), [(1, 2), (2, 1)])
+
+    def test_resume(self):
+        # the first run commits the shadow table and one batch, then fails; running it again finishes the job
+        save_progress = batchmigrate._save_progress
+        def fail_after_first_batch(connection, name, last_key, rows):
+            save_progress(connection, name, last_key, rows)
+            raise RuntimeError('interrupted')
+        with mock.patch.object(batchmigrate, '_save_progress', fail_after_first_batch):
+            self.assertRaises(RuntimeError, self.migrate, self.rebuild_followers)
+        inspector = db.inspect(db.engine)
+        self.assertTrue(inspector.has_table('_followers_new'))
+        self.assertEqual(db.session.execute(db.select(batchmigrate.progress.c.last_key)).scalar(), 1)
+        self.migrate(self.rebuild_followers)
+        self.assertEqual(sorted(db.session.execute(db.select(followers)).all()), [(1, 2), (2, 1)])
+        inspector = db.inspect(db.engine)
+        self.assertFalse(inspector.has_table('_followers_new'))
+        self.assertFalse(inspector.has_table('migration_progress'))
+
+    def test_copy_checks_count(self):
+        # a row written to an already copied range during the copy is missing from the shadow, which is not swapped in
+        save_progress = batchmigrate._save_progress
+        def write_behind(connection, name, last_key, rows):
+            save_progress(connection, name, last_key, rows)
+            if last_key == 1:
+                connection.execute(followers.insert().values(follower_id=1, followed_id=1))
+        with mock.patch.object(batchmigrate, '_save_progress', write_behind):
+            self.assertRaises(RuntimeError, self.migrate, self.rebuild_followers)
+        self.assertEqual(db.session.execute(db.select(db.func.count()).select_from(followers)).scalar(), 7)
+        self.assertTrue(db.inspect(db.engine).has_table('_followers_new'))
+
+class AssetsCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = app.config['ASSETS_DIST'], app.config['ASSETS_VENDOR']
+        app.config['ASSETS_DIST'] = os.path.join(self.directory, 'dist')
+        app.config['ASSETS_VENDOR'] = os.path.join(self.directory, 'vendor')
+        os.mkdir(app.config['ASSETS_VENDOR'])
+        with open(os.path.join(app.config['ASSETS_VENDOR'], assets.MOMENT_FILE), 'w') as f:
+            f.write('window.moment = function () {};')
+
+    def tearDown(self):
+        app.config['ASSETS_DIST'], app.config['ASSETS_VENDOR'] = self.config
+        assets.load_manifest()
+        shutil.rmtree(self.directory)
+
+    def test_build_and_serve(self):
+        with app.app_context():
+            manifest = assets.build()
+        self.assertEqual(sorted(manifest), ['app.css', 'app.js', 'availability.js', 'loading.gif'])
+        self.assertRegex(manifest['app.js'], r'^app\.[0-9a-f]{12}\.js$')
+        with open(os.path.join(app.config['ASSETS_DIST'], manifest['app.css'])) as f:
+            css = f.read()
+        self.assertNotIn('../fonts/', css)
+        self.assertRegex(css, r'url\(glyphicons-halflings-regular\.[0-9a-f]{12}\.woff2\)')
+        # rebuilding unchanged sources gives the same names
+        with app.app_context():
+            self.assertEqual(assets.build(), manifest)
+
+        client = app.test_client()
+        response = client.get('/assets/' + manifest['app.js'], headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/javascript')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn(b'function translate(', gzip.decompress(response.get_data()))
+        response = client.get('/assets/' + manifest['app.js'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(client.get('/assets/' + manifest['app.js'] + '.gz').status_code, 404)
+
+        with app.app_context():
+            page = client.get('/login').get_data(as_text=True)
+        self.assertIn('/assets/' + manifest['app.css'], page)
+        self.assertIn('/assets/' + manifest['app.js'], page)
+        self.assertNotIn('cdnjs', page)
+
+class ProfilingCase(unittest.TestCase):
+    #requests are made outside an app context, so that each one gets its own g and logged in user
+    def setUp(self):
+        with app.app_context():
+            db.create_all()
+        self.directory = tempfile.mkdtemp()
+        self.config = app.config['PROFILE_DIR'], app.config['PROFILE_MODE']
+        app.config['PROFILE_DIR'] = self.directory
+
+    def tearDown(self):
+        app.config['PROFILE_DIR'], app.config['PROFILE_MODE'] = self.config
+        shutil.rmtree(self.directory)
+        with app.app_context():
+            db.drop_all()
+
+    def test_profile_requests(self):
+        client = app.test_client()
+        self.assertNotIn('X-Profile', client.get('/login').headers)
+        self.assertNotIn('X-Profile', client.get('/login?profile=1').headers)
+        self.assertNotIn('X-Profile', client.get('/login', headers={'X-Profile-Token': 'forged'}).headers)
+
+        token = profiling.get_profile_token()
+        name = client.get('/login', headers={'X-Profile-Token': token}).headers['X-Profile']
+        self.assertRegex(name, r'^\d{8}T\d{6}-login\.prof$')
+        app.config['PROFILE_MODE'] = 'sample'
+        name = client.get('/login?profile=' + token).headers['X-Profile']
+        self.assertTrue(name.endswith('-login.collapsed'))
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+        # the sampler cannot see greenlets, so sample mode refuses under monkey-patched workers
+        with mock.patch.object(profiling, '_green_threads', return_value='gevent'):
+            response = client.get('/login?profile=' + token)
+        self.assertNotIn('X-Profile', response.headers)
+        self.assertIn('PROFILE_MODE=cprofile', response.headers['X-Profile-Error'])
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+        # the saved profiles are listed to admins only
+        with app.app_context():
+            admin = User(username='admin', email=app.config['ADMINS'][0])
+            susan = User(username='susan', email='susan@example.com')
+            db.session.add_all([admin, susan])
+            db.session.commit()
+            admin_id, susan_id = admin.id, susan.id
+        with client.session_transaction() as session:
+            session['_user_id'] = str(susan_id)
+        self.assertEqual(client.get('/admin/profiles').status_code, 403)
+        self.assertNotIn('X-Profile', client.get('/login?profile=1').headers)
+        with client.session_transaction() as session:
+            session['_user_id'] = str(admin_id)
+        self.assertIn('X-Profile', client.get('/explore?profile=1').headers)
+        listing = client.get('/admin/profiles').get_data(as_text=True)
+        self.assertIn(name, listing)
+        report = [n for n in os.listdir(self.directory) if n.endswith('-explore.collapsed')][0]
+        self.assertEqual(client.get('/admin/profiles/' + report).mimetype, 'text/plain')
+        app.config['PROFILE_MODE'] = 'cprofile'
+        prof = client.get('/explore?profile=1').headers['X-Profile']
+        self.assertIn('function calls', client.get('/admin/profiles/' + prof).get_data(as_text=True))
+        self.assertEqual(client.get('/admin/profiles/..%2Fapp.db').status_code, 404)
+
+class CatalogsCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = catalogs.TRANSLATIONS, catalogs.CACHE_FILE
+        catalogs.TRANSLATIONS = os.path.join(self.directory, 'translations')
+        catalogs.CACHE_FILE = os.path.join(self.directory, 'cache.json')
+
+    def tearDown(self):
+        catalogs.TRANSLATIONS, catalogs.CACHE_FILE = self.paths
+        shutil.rmtree(self.directory)
+
+    def test_incremental_build(self):
+        template, files, parsed = catalogs.extract()
+        self.assertEqual(parsed, files)
+        self.assertIn('Please log in to access this page', template)
+        self.assertEqual(catalogs.extract()[2], 0)
+
+        catalogs.init(template, 'fr')
+        catalogs.init(template, 'de')
+        self.assertEqual(catalogs.update(template), [])
+        self.assertEqual(catalogs.stale_languages(), ['de', 'fr'])
+        self.assertEqual(sorted(result[0] for result in catalogs.compile(['de', 'fr'])), ['de', 'fr'])
+        self.assertEqual(catalogs.stale_languages(), [])
+
+        # a new message only rewrites the .po files, which then need compiling again
+        template.add('A brand new message', locations=[('app/routes.py', 1)])
+        self.assertEqual(catalogs.update(template), ['de', 'fr'])
+        with open(os.path.join(catalogs.TRANSLATIONS, 'fr', 'LC_MESSAGES', 'messages.po')) as f:
+            self.assertIn('msgid "A brand new message"', f.read())
+
+class CompressCase(unittest.TestCase):
+    page = ('<html>\n  <body>\n    <p>a    b</p>\n\n    <pre>  keep\n    this  </pre>\n'
+            '    <a title="x   y > z"  href="#">  link  </a><textarea>  t\n\n  t  </textarea>\n'
+            '    <script>\n  var  x = 1;\n    </script>\n' + '    <div>   row   </div>\n' * 100 + '  </body>\n</html>\n')
+
+    def wsgi(self, chunks, content_type='text/html; charset=utf-8', headers=()):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', content_type)] + list(headers))
+            return iter(chunks)
+        return compress.Compressor(application, app.config)
+
+    def get(self, wsgi, accept_encoding=''):
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response.update(headers)
+        body = b''.join(wsgi({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': accept_encoding}, start_response))
+        return response, body
+
+    def test_minify_html(self):
+        minified = compress.minify_html(self.page)
+        self.assertIn('<p>a b</p>\n<pre>  keep\n    this  </pre>', minified)
+        self.assertIn('<script>\n  var  x = 1;\n    </script>', minified)
+        # attribute values and textarea contents are left alone
+        self.assertIn('<a title="x   y > z"  href="#"> link </a><textarea>  t\n\n  t  </textarea>', minified)
+        self.assertIn('<div> row </div>\n<div>', minified)
+        # chunk boundaries anywhere in the page give the same result
+        data = self.page.encode()
+        for size in (1, 7, 64):
+            minifier = compress.HTMLMinifier('utf-8')
+            chunks = [minifier.feed(data[n:n + size]) for n in range(0, len(data), size)]
+            self.assertEqual((b''.join(chunks) + minifier.finish()).decode(), minified)
+
+    def test_middleware(self):
+        data = self.page.encode()
+        chunks = [data[n:n + 100] for n in range(0, len(data), 100)]
+        headers, body = self.get(self.wsgi(chunks), 'gzip, deflate')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(gzip.decompress(body).decode(), compress.minify_html(self.page))
+        headers, body = self.get(self.wsgi(chunks, headers=[('Accept-Ranges', 'bytes')]), 'gzip')
+        self.assertNotIn('Accept-Ranges', headers)
+
+        headers, body = self.get(self.wsgi(chunks), 'gzip;q=0')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(body.decode(), compress.minify_html(self.page))
+        headers, body = self.get(self.wsgi([b'<p>small</p>']), 'gzip')
+        self.assertEqual((headers['Content-Length'], body), ('12', b'<p>small</p>'))
+        headers, body = self.get(self.wsgi(chunks, 'text/event-stream'), 'gzip')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(body, data)
+
+        with app.app_context():
+            db.create_all()
+            response = app.test_client().get('/login', headers={'Accept-Encoding': 'gzip'})
+            db.drop_all()
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'<form', gzip.decompress(response.get_data()))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)